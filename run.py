@@ -38,12 +38,21 @@ def main():
             logging.warning("⚠️ No LLM API keys found - using mock responses")
             logging.warning("Set AZURE_OPENAI_ENDPOINT + AZURE_OPENAI_API_KEY or OPENAI_API_KEY for real responses")
         
-        # Start server
+        # Start server (reload is for local development only; it disables uvloop)
+        reload = os.getenv("RELOAD", "0") == "1"
+        # One worker per core in production; reload mode only supports a single process
+        workers = 1 if reload else int(os.getenv("WORKERS", os.cpu_count() or 1))
+        logging.info(f"Workers: {workers}")
         uvicorn.run(
             "src.main:app",
             host=host,
             port=port,
-            reload=True
+            reload=reload,
+            loop="auto" if reload else "uvloop",
+            http="httptools",
+            workers=workers,
+            # Outlive typical upstream proxy idle timeouts so client connections get reused
+            timeout_keep_alive=int(os.getenv("KEEP_ALIVE_TIMEOUT", 30)),
         )
     except Exception as e:
         logging.error(f"Error starting server: {str(e)}")
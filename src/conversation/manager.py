@@ -172,7 +172,9 @@ class ConversationManager:
         try:
             if self.use_redis:
                 key = f"conversation:{conversation_id}"
-                self.redis.setex(
+                # Sync Redis client: run off the event loop so callers are not blocked
+                await asyncio.to_thread(
+                    self.redis.setex,
                     key,
                     self.message_ttl,
                     json.dumps(data)
@@ -188,7 +190,7 @@ class ConversationManager:
         try:
             if self.use_redis:
                 key = f"conversation:{conversation_id}"
-                data = self.redis.get(key)
+                data = await asyncio.to_thread(self.redis.get, key)
                 return json.loads(data) if data else None
             else:
                 # Get from memory
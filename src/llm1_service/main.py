@@ -10,13 +10,15 @@ for var in REQUIRED_VARS:
 
 from fastapi import FastAPI, HTTPException, Request, Header
 from pydantic import BaseModel
-from service import generate_context
+from service import generate_context, warmup
 import logging
 import time
 import uuid
+import re
+import traceback
 from fastapi import Depends
 
-logging.basicConfig(level=logging.INFO)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger("llm1_service")
 
 app = FastAPI(title="LLM1 Service - Prompt/Context Generator")
@@ -49,10 +51,13 @@ async def generate_context_endpoint(req: LLM1Request, request: Request):
         logger.info(f"[request_id={request_id}] /generate-context response: context length={len(result.get('context',''))}, rules keys={list(result.get('rules',{}).keys())}")
         return LLM1Response(**result)
     except Exception as e:
-        import traceback
         logger.error(f"[request_id={request_id}] LLM1 error: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.on_event("startup")
+async def warmup_azure_client():
+    await warmup()
+
 @app.get("/health")
 async def health():
     missing = [var for var in REQUIRED_VARS if not os.getenv(var)]
@@ -61,9 +66,15 @@ async def health():
         return {"status": "error", "error": f"Missing env vars: {missing}"}, 500
     return {"status": "ok"}
 
+# Accepted shape for an incoming x-request-id; anything else gets a fresh id
+REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    request_id = str(uuid.uuid4())
+    # Adopt the caller's id when it is well-formed, so logs line up with the orchestrator's
+    request_id = request.headers.get("x-request-id", "")
+    if not REQUEST_ID_RE.fullmatch(request_id):
+        request_id = str(uuid.uuid4())
     request.state.request_id = request_id
     logger.info(f"[request_id={request_id}] Request: {request.method} {request.url}")
     start = time.time()
@@ -73,6 +84,5 @@ async def log_requests(request: Request, call_next):
         logger.info(f"[request_id={request_id}] Response status: {response.status_code} | Latency: {latency:.2f}ms")
         return response
     except Exception as e:
-        import traceback
         logger.error(f"[request_id={request_id}] Error: {e}\n{traceback.format_exc()}")
         raise 
\ No newline at end of file
@@ -2,10 +2,11 @@
 
 import os
 import logging
-from openai import AsyncAzureOpenAI
+from openai import AsyncAzureOpenAI, RateLimitError, APIStatusError
 import traceback
 import asyncio
 import random
+import functools
 
 # Update for gpt-4.1-mini deployment
 GPT41_MINI_ENDPOINT = os.getenv("AZURE_GPT41_MINI_ENDPOINT", "https://ai-anuragpradeepjha5004ai785724618017.openai.azure.com/")
@@ -13,6 +14,9 @@ GPT41_MINI_API_KEY = os.getenv("AZURE_GPT41_MINI_API_KEY")
 GPT41_MINI_DEPLOYMENT = os.getenv("AZURE_GPT41_MINI_DEPLOYMENT", "gpt-4.1-mini")
 GPT41_MINI_API_VERSION = os.getenv("AZURE_GPT41_MINI_API_VERSION", "2024-12-01-preview")
 
+# Add environment variable for max tokens (context is 1-2 sentences)
+MAX_COMPLETION_TOKENS = int(os.getenv("LLM1_MAX_COMPLETION_TOKENS", "64"))
+
 # Validate required env vars
 if not GPT41_MINI_ENDPOINT or not isinstance(GPT41_MINI_ENDPOINT, str):
     raise RuntimeError("Missing or invalid AZURE_GPT41_MINI_ENDPOINT environment variable.")
@@ -30,26 +34,62 @@ logging.info(f"[LLM1] GPT41_MINI_ENDPOINT={GPT41_MINI_ENDPOINT}")
 logging.info(f"[LLM1] GPT41_MINI_DEPLOYMENT={GPT41_MINI_DEPLOYMENT}")
 logging.info(f"[LLM1] GPT41_MINI_API_VERSION={GPT41_MINI_API_VERSION}")
 
-async def generate_context(user_input: str, character_details: dict, session_id: str = None, history: list = None, temperature: float = 0.7, top_p: float = 0.95):
-    name = character_details.get("name", "Character")
-    persona = character_details.get("personality", "default persona")
-    voice_type = character_details.get("voice_type", "predefined")
-    prompt = f"You are {name}. {character_details.get('description', '')} Your personality traits are: {persona}. Respond in character, being concise and engaging."
+SYSTEM_PROMPT = "You are a friendly, concise conversational partner. Always reply in 1-2 sentences, like a real human chat. Avoid long or formal responses."
+
+@functools.lru_cache(maxsize=4096)
+def _build_prefix(name, persona, description, voice_type, style, forbidden_topics):
+    # Pure helper so the persona prompt and rules are only formatted once per character
+    prompt = f"You are {name}. {description} Your personality traits are: {persona}. Respond in character, being concise and engaging."
+    rules = {
+        "persona": persona,
+        "style": style,
+        "forbidden_topics": list(forbidden_topics),
+        "voice_type": voice_type,
+    }
+    return prompt, rules
+
+def get_prefix(character_details: dict):
+    forbidden_topics = character_details.get("forbidden_topics", [])
+    args = (
+        character_details.get("name", "Character"),
+        character_details.get("personality", "default persona"),
+        character_details.get("description", ""),
+        character_details.get("voice_type", "predefined"),
+        character_details.get("style", "default"),
+        tuple(forbidden_topics) if isinstance(forbidden_topics, (list, tuple)) else (forbidden_topics,),
+    )
+    try:
+        prompt, rules = _build_prefix(*args)
+    except TypeError:
+        # Unhashable character fields cannot be cached; build uncached
+        prompt, rules = _build_prefix.__wrapped__(*args)
+    return prompt, {**rules, "forbidden_topics": list(rules["forbidden_topics"])}
+
+def _is_rate_limited(e: Exception) -> bool:
+    return isinstance(e, RateLimitError) or (isinstance(e, APIStatusError) and e.status_code == 429)
+
+async def generate_context(user_input: str, character_details: dict, session_id: str = None, history: list = None, temperature: float = 0.7, top_p: float = 0.95, stream: bool = True):
+    prompt, rules = get_prefix(character_details)
     max_retries = 5
     for attempt in range(max_retries):
         try:
             response_params = {
                 "messages": [
-                    {"role": "system", "content": "You are a friendly, concise conversational partner. Always reply in 1-2 sentences, like a real human chat. Avoid long or formal responses."},
+                    {"role": "system", "content": SYSTEM_PROMPT},
                     {"role": "user", "content": prompt}
                 ],
-                "max_completion_tokens": 64,  # Lowered for concise context
+                "max_completion_tokens": MAX_COMPLETION_TOKENS,
                 "temperature": 0.7,
                 "top_p": top_p,
                 "model": GPT41_MINI_DEPLOYMENT,
-                "stream": True,
+                "stream": stream,
             }
             start_time = asyncio.get_event_loop().time()
+            if not stream:
+                response = await client.chat.completions.create(**response_params)
+                full_context = (response.choices[0].message.content or "") if response.choices else ""
+                logging.debug("[LLM1] Final: %r @ %.3fs", full_context, asyncio.get_event_loop().time() - start_time)
+                return {"context": full_context, "rules": rules}
             response_stream = await client.chat.completions.create(**response_params)
             full_context = ""
             async for chunk in response_stream:
@@ -58,14 +98,7 @@ async def generate_context(user_input: str, character_details: dict, session_id:
                 delta = getattr(chunk.choices[0], 'delta', None)
                 if delta and hasattr(delta, 'content') and delta.content:
                     full_context += delta.content
-                    logging.info(f"[LLM1] [stream] Partial: {repr(full_context)} @ {asyncio.get_event_loop().time() - start_time:.3f}s")
-            logging.info(f"[LLM1] [stream] Final: {repr(full_context)} @ {asyncio.get_event_loop().time() - start_time:.3f}s")
-            rules = {
-                "persona": persona,
-                "style": character_details.get("style", "default"),
-                "forbidden_topics": character_details.get("forbidden_topics", []),
-                "voice_type": voice_type,
-            }
+            logging.debug("[LLM1] [stream] Final: %r @ %.3fs", full_context, asyncio.get_event_loop().time() - start_time)
             return {"context": full_context, "rules": rules}
         except Exception as e:
             wait_time = None
@@ -77,7 +110,7 @@ async def generate_context(user_input: str, character_details: dict, session_id:
                         wait_time = int(retry_after)
                     except Exception:
                         pass
-            if ("429" in str(e) or "RateLimitError" in str(e)) and attempt < max_retries - 1:
+            if _is_rate_limited(e) and attempt < max_retries - 1:
                 if wait_time is None:
                     wait_time = 2 ** attempt  # fallback exponential backoff
                 # Add jitter to avoid thundering herd
@@ -87,4 +120,12 @@ async def generate_context(user_input: str, character_details: dict, session_id:
                 await asyncio.sleep(total_wait)
                 continue
             logging.error(f"[LLM1] OpenAI call failed (attempt {attempt+1}/{max_retries}): {e}\n{traceback.format_exc()}")
-            return {"context": "fallback-context", "rules": {}, "error": str(e)} 
\ No newline at end of file
+            return {"context": "fallback-context", "rules": {}, "error": str(e)}
+
+async def warmup():
+    # Open the TLS connection (and resolve DNS) before the first user request pays for it
+    try:
+        await client.models.list()
+        logging.info("[LLM1] Azure OpenAI connection warmed up")
+    except Exception as e:
+        logging.warning(f"[LLM1] Azure OpenAI warmup failed: {e}")
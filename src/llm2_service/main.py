@@ -1,40 +1,87 @@
-import os
-import openai, httpx
-print(f"[DEBUG] openai version: {openai.__version__}")
-print(f"[DEBUG] httpx version: {httpx.__version__}")
-
-# Validate required env vars at startup
-REQUIRED_VARS = ["AZURE_GPT4O_MINI_ENDPOINT", "AZURE_GPT4O_MINI_API_KEY"]
-for var in REQUIRED_VARS:
-    if not os.getenv(var):
-        import sys
-        print(f"[FATAL] Missing required environment variable: {var}", file=sys.stderr)
-        sys.exit(1)
+from pydantic import ValidationError
+from settings import get_settings
+
+# Validate required env vars once at startup; everything below reads the cached settings
+try:
+    settings = get_settings()
+except ValidationError as e:
+    import sys
+    print(f"[FATAL] Invalid environment configuration: {e}", file=sys.stderr)
+    sys.exit(1)
 
 from fastapi import FastAPI, HTTPException, Request, Header
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
-from service import generate_response
+from typing import Optional, List
+from service import generate_response, stream_response, submit_batch, get_batch, warmup, shutdown
 import logging
-import time
-import uuid
+import logging.handlers
+import queue
+import orjson
+import traceback
+import asyncio
+import itertools
+import secrets
+import re
 from fastapi import Depends
 
-logging.basicConfig(level=logging.INFO)
+LOG_RECORD_FIELDS = ("request_id", "method", "path", "status", "latency_ms", "user_query_len", "persona_context_len", "model", "response_len")
+
+class JSONFormatter(logging.Formatter):
+    # One JSON object per record; request fields are passed via `extra=`
+    def format(self, record):
+        entry = {"ts": record.created, "level": record.levelname, "logger": record.name, "msg": record.getMessage()}
+        for field in LOG_RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+def configure_logging():
+    # Records are enqueued on the event loop thread; formatting and the stderr write
+    # happen on the QueueListener thread.
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JSONFormatter())
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(settings.log_level.upper())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+log_listener = configure_logging()
 logger = logging.getLogger("llm2_service")
 
-app = FastAPI(title="LLM2 Service - Character Brain")
+app = FastAPI(title="LLM2 Service - Character Brain", default_response_class=ORJSONResponse)
+
+# Cheap request ids for log correlation: per-process random prefix + counter
+_request_id_prefix = secrets.token_hex(4)
+_request_id_counter = itertools.count()
+# Accepted shape for an incoming x-request-id; anything else gets a local one
+REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._:-]{1,128}")
 
 class LLM2Request(BaseModel):
     user_query: str
     persona_context: str
     rules: dict
     model: Optional[str] = None
+    # Conversation so far (oldest first); omitted for stateless calls
+    history: Optional[list] = None
+    session_id: Optional[str] = None
 
 class LLM2Response(BaseModel):
     response: str
 
-INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY", "changeme-internal-key")
+class LLM2BatchItem(LLM2Request):
+    custom_id: Optional[str] = None
+
+class LLM2BatchRequest(BaseModel):
+    requests: List[LLM2BatchItem]
+
+INTERNAL_API_KEY = settings.internal_api_key
 
 async def verify_internal_api_key(x_internal_api_key: str = Header(...)):
     if x_internal_api_key != INTERNAL_API_KEY:
@@ -44,39 +91,75 @@ async def verify_internal_api_key(x_internal_api_key: str = Header(...)):
 @app.post("/generate-response", dependencies=[Depends(verify_internal_api_key)], response_model=LLM2Response)
 async def generate_response_endpoint(req: LLM2Request, request: Request):
     request_id = getattr(request.state, 'request_id', 'unknown')
-    logger.info(f"[request_id={request_id}] /generate-response payload: user_query length={len(req.user_query)}, persona_context length={len(req.persona_context)}, rules keys={list(req.rules.keys())}, model={req.model}")
-    missing = [var for var in REQUIRED_VARS if not os.getenv(var)]
-    if missing:
-        logger.warning(f"[request_id={request_id}] /generate-response called but missing: {missing}")
+    request.state.log_fields = {"user_query_len": len(req.user_query), "persona_context_len": len(req.persona_context), "model": req.model}
     try:
-        result = await generate_response(req.user_query, req.persona_context, req.rules, req.model)
-        logger.info(f"[request_id={request_id}] /generate-response response: response length={len(result.get('response',''))}")
+        result = await generate_response(req.user_query, req.persona_context, req.rules, req.model, session_id=req.session_id, history=req.history)
+        request.state.log_fields["response_len"] = len(result.get("response", ""))
         return LLM2Response(response=result["response"])
     except Exception as e:
-        import traceback
         logger.error(f"[request_id={request_id}] LLM2 error: {e}\n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/stream-response", dependencies=[Depends(verify_internal_api_key)])
+async def stream_response_endpoint(req: LLM2Request, request: Request):
+    """Streams the reply as plain-text deltas so callers can forward tokens as they arrive."""
+    request.state.log_fields = {"user_query_len": len(req.user_query), "persona_context_len": len(req.persona_context), "model": req.model}
+    return StreamingResponse(stream_response(req.user_query, req.persona_context, req.rules, req.model, session_id=req.session_id, history=req.history), media_type="text/plain")
+
+@app.post("/batch-response", dependencies=[Depends(verify_internal_api_key)])
+async def batch_response_endpoint(req: LLM2BatchRequest, request: Request):
+    """Submits non-interactive requests as one Azure Batch job; poll GET /batch-response/{batch_id}."""
+    if not req.requests:
+        raise HTTPException(status_code=400, detail="requests must not be empty")
+    try:
+        return await submit_batch([item.dict() for item in req.requests])
+    except Exception as e:
+        logger.error(f"[request_id={request.state.request_id}] LLM2 batch submit error: {e}")
+        raise HTTPException(status_code=502, detail=str(e))
+
+@app.get("/batch-response/{batch_id}", dependencies=[Depends(verify_internal_api_key)])
+async def batch_status_endpoint(batch_id: str, request: Request):
+    try:
+        return await get_batch(batch_id)
+    except Exception as e:
+        logger.error(f"[request_id={request.state.request_id}] LLM2 batch status error: {e}")
+        raise HTTPException(status_code=502, detail=str(e))
+
+@app.on_event("startup")
+async def warmup_azure_client():
+    await warmup()
+
+@app.on_event("shutdown")
+async def stop_log_listener():
+    await shutdown()
+    log_listener.stop()
+
 @app.get("/health")
 async def health():
-    missing = [var for var in REQUIRED_VARS if not os.getenv(var)]
-    if missing:
-        logger.warning(f"[LLM2] /health called but missing: {missing}")
-        return {"status": "error", "error": f"Missing env vars: {missing}"}, 500
+    # Config was validated at import; a running process always has it
     return {"status": "ok"}
 
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    request_id = str(uuid.uuid4())
+    # Adopt the caller's id when it is well-formed, so logs line up with the orchestrator's
+    request_id = request.headers.get("x-request-id", "")
+    if not REQUEST_ID_RE.fullmatch(request_id):
+        request_id = f"{_request_id_prefix}-{next(_request_id_counter):016x}"
     request.state.request_id = request_id
-    logger.info(f"[request_id={request_id}] Request: {request.method} {request.url}")
-    start = time.time()
+    loop = asyncio.get_running_loop()
+    start = loop.time()
     try:
         response = await call_next(request)
-        latency = (time.time() - start) * 1000
-        logger.info(f"[request_id={request_id}] Response status: {response.status_code} | Latency: {latency:.2f}ms")
+        latency = (loop.time() - start) * 1000
+        logger.info("req", extra={
+            "request_id": request_id,
+            "method": request.method,
+            "path": request.url.path,
+            "status": response.status_code,
+            "latency_ms": round(latency, 2),
+            **getattr(request.state, "log_fields", {}),
+        })
         return response
     except Exception as e:
-        import traceback
         logger.error(f"[request_id={request_id}] Error: {e}\n{traceback.format_exc()}")
         raise 
\ No newline at end of file
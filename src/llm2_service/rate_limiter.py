@@ -0,0 +1,67 @@
+# Client-side rate limiting for Azure OpenAI deployments (keeps us under the rpm/tpm quota)
+
+import asyncio
+import time
+
+class TokenBucket:
+    """Async token bucket refilled continuously at `capacity` per `period` seconds."""
+    def __init__(self, capacity: int, period: float = 60.0):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        # A single request larger than the bucket would wait forever; let it drain the bucket instead
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, amount: float):
+        # Positive charges extra usage, negative refunds an over-estimate
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+class EndpointLimiter:
+    """
+    Per-deployment limiter: caps in-flight calls, requests/min and tokens/min.
+    rpm/tpm of 0 disable that bucket. A 429 with retry-after pauses every caller of the deployment.
+    """
+    def __init__(self, concurrency: int, rpm: int = 0, tpm: int = 0):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.paused_until = 0.0
+
+    async def acquire(self, estimated_tokens: int = 0):
+        await self.semaphore.acquire()
+        try:
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if self.requests:
+                await self.requests.acquire(1)
+            if self.tokens and estimated_tokens:
+                await self.tokens.acquire(estimated_tokens)
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    def release(self):
+        self.semaphore.release()
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        if self.tokens:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
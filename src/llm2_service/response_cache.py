@@ -0,0 +1,69 @@
+# In-memory response cache for LLM2 (ConvoCache-style reuse of prior replies)
+
+import re
+from collections import OrderedDict
+
+_WORD_RE = re.compile(r"[a-z0-9']+")
+
+def normalize(text: str) -> str:
+    return " ".join(_WORD_RE.findall(text.lower()))
+
+def similarity(a: frozenset, b: frozenset) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class ResponseCache:
+    """
+    LRU cache of replies, namespaced per persona so characters never share answers.
+    Lookup is exact on the normalized query first, then falls back to the most similar
+    cached query in the namespace (token-set Jaccard) if it scores >= threshold.
+    Only queries of at most fuzzy_max_tokens words are matched fuzzily: in longer ones a
+    single changed word ("do" / "don't") can flip the meaning while barely moving the score.
+    """
+    def __init__(self, max_namespaces=1024, max_entries=256, threshold=0.9, fuzzy_max_tokens=4):
+        self.max_namespaces = max_namespaces
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.fuzzy_max_tokens = fuzzy_max_tokens
+        self._namespaces = OrderedDict()
+
+    def get(self, namespace: str, query: str):
+        entries = self._namespaces.get(namespace)
+        if not entries:
+            return None
+        self._namespaces.move_to_end(namespace)
+        key = normalize(query)
+        hit = entries.get(key)
+        if hit is not None:
+            entries.move_to_end(key)
+            return hit[1]
+        if self.threshold >= 1.0:
+            return None
+        words = key.split()
+        if len(words) > self.fuzzy_max_tokens:
+            return None
+        tokens = frozenset(words)
+        best_key, best_score = None, 0.0
+        for cached_key, (cached_tokens, _) in entries.items():
+            score = similarity(tokens, cached_tokens)
+            if score > best_score:
+                best_key, best_score = cached_key, score
+        if best_key is None or best_score < self.threshold:
+            return None
+        entries.move_to_end(best_key)
+        return entries[best_key][1]
+
+    def put(self, namespace: str, query: str, response: str):
+        entries = self._namespaces.get(namespace)
+        if entries is None:
+            entries = self._namespaces[namespace] = OrderedDict()
+            if len(self._namespaces) > self.max_namespaces:
+                self._namespaces.popitem(last=False)
+        else:
+            self._namespaces.move_to_end(namespace)
+        key = normalize(query)
+        entries[key] = (frozenset(key.split()), response)
+        entries.move_to_end(key)
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
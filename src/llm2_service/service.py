@@ -1,24 +1,52 @@
 # LLM2 Service Logic (Persona/Character Brain)
 
-import os
 import logging
-from openai import AsyncAzureOpenAI
+from openai import AsyncAzureOpenAI, RateLimitError, APIStatusError
 import openai, httpx
 import traceback
 import random
 import asyncio
+import json
+import hashlib
+from collections import OrderedDict
+from pydantic import ValidationError
+from response_cache import ResponseCache
+from rate_limiter import EndpointLimiter
+from settings import get_settings
 
-print(f"[DEBUG] openai version: {openai.__version__}")
-print(f"[DEBUG] httpx version: {httpx.__version__}")
+# Optional tiktoken dependency for exact token counts
+try:
+    import tiktoken
+    _enc = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _enc = None
+    logging.warning("[LLM2] tiktoken not available - approximating history token counts")
+
+logging.debug("[LLM2] openai version: %s, httpx version: %s", openai.__version__, httpx.__version__)
 
 # Update for gpt-4o-mini deployment
-GPT4O_MINI_ENDPOINT = os.getenv("AZURE_GPT4O_MINI_ENDPOINT", "https://ai-anuragpradeepjha5004ai785724618017.openai.azure.com/")
-GPT4O_MINI_API_KEY = os.getenv("AZURE_GPT4O_MINI_API_KEY")
-GPT4O_MINI_DEPLOYMENT = os.getenv("AZURE_GPT4O_MINI_DEPLOYMENT", "gpt-4o-mini")
-GPT4O_MINI_API_VERSION = os.getenv("AZURE_GPT4O_MINI_API_VERSION", "2024-12-01-preview")
+try:
+    settings = get_settings()
+except ValidationError as e:
+    raise RuntimeError(f"Missing or invalid LLM2 environment configuration: {e}") from e
+
+GPT4O_MINI_ENDPOINT = settings.azure_gpt4o_mini_endpoint
+GPT4O_MINI_API_KEY = settings.azure_gpt4o_mini_api_key
+GPT4O_MINI_DEPLOYMENT = settings.azure_gpt4o_mini_deployment
+GPT4O_MINI_API_VERSION = settings.azure_gpt4o_mini_api_version
 
 # Add environment variable for max tokens
-MAX_COMPLETION_TOKENS = int(os.getenv("LLM2_MAX_COMPLETION_TOKENS", "1024"))
+MAX_COMPLETION_TOKENS = settings.llm2_max_completion_tokens
+
+# History layout: the last HISTORY_WINDOW turns are sent verbatim, older turns are folded
+# into a single memory message that only moves every MEMORY_REFRESH_TURNS turns, so the
+# prompt prefix stays byte-identical between turns and provider prompt caching can hit.
+HISTORY_WINDOW = settings.llm2_history_window
+MEMORY_REFRESH_TURNS = settings.llm2_memory_refresh_turns
+MEMORY_TURN_CHARS = 200
+HISTORY_TOKEN_BUDGET = settings.llm2_history_token_budget
+
+STATIC_SYSTEM_PROMPT = "Reply in a short, natural, conversational way. No more than 2 sentences. Avoid long or formal responses."
 
 # Validate required env vars
 if not GPT4O_MINI_ENDPOINT or not isinstance(GPT4O_MINI_ENDPOINT, str):
@@ -26,64 +54,274 @@ if not GPT4O_MINI_ENDPOINT or not isinstance(GPT4O_MINI_ENDPOINT, str):
 if not GPT4O_MINI_API_KEY or not isinstance(GPT4O_MINI_API_KEY, str):
     raise RuntimeError("Missing or invalid AZURE_GPT4O_MINI_API_KEY environment variable.")
 
+# Concurrency cap for in-flight Azure calls (per endpoint quota)
+LLM_CONCURRENCY = settings.llm_conc
+LLM2_RPM = settings.llm2_rpm
+LLM2_TPM = settings.llm2_tpm
+BATCH_DEPLOYMENT = settings.llm2_batch_deployment
+
+# One pooled HTTP/2 connection set shared by every request in this process
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=100),
+    timeout=httpx.Timeout(30.0, connect=5.0),
+)
+
 client = AsyncAzureOpenAI(
     api_version=GPT4O_MINI_API_VERSION,
     azure_endpoint=GPT4O_MINI_ENDPOINT,
     api_key=GPT4O_MINI_API_KEY,
+    http_client=http_client,
+)
+
+# One limiter per deployment: concurrency (LLM_CONC) plus rpm/tpm buckets sized to its quota
+_limiters = {}
+
+def get_limiter(deployment: str) -> EndpointLimiter:
+    limiter = _limiters.get(deployment)
+    if limiter is None:
+        limiter = _limiters[deployment] = EndpointLimiter(LLM_CONCURRENCY, LLM2_RPM, LLM2_TPM)
+    return limiter
+
+# Reuse replies for repeated/near-identical stateless queries per persona
+RESPONSE_CACHE_ENABLED = settings.llm2_response_cache
+response_cache = ResponseCache(
+    max_entries=settings.llm2_response_cache_size,
+    threshold=settings.llm2_response_cache_similarity,
+    fuzzy_max_tokens=settings.llm2_response_cache_fuzzy_max_tokens,
 )
 
+# In-flight completions keyed by request hash, so identical concurrent prompts share one call
+_inflight = {}
+
 # Log environment variables at startup (except API key)
 logging.info(f"[LLM2] GPT4O_MINI_ENDPOINT={GPT4O_MINI_ENDPOINT}")
 logging.info(f"[LLM2] GPT4O_MINI_DEPLOYMENT={GPT4O_MINI_DEPLOYMENT}")
 logging.info(f"[LLM2] GPT4O_MINI_API_VERSION={GPT4O_MINI_API_VERSION}")
 
-async def generate_response(user_query: str, persona_context: str, rules: dict = None, model: str = None, session_id: str = None, history: list = None, temperature: float = 1.0, top_p: float = 1.0):
-    logging.info(f"[LLM2] generate_response called with session_id={session_id}, user_query={user_query}")
-    messages = [
-        {"role": "system", "content": "Reply in a short, natural, conversational way. No more than 2 sentences. Avoid long or formal responses."},
+def canonical_json(value) -> str:
+    # Deterministic encoding so identical rules always produce identical prompt bytes
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+def _history_role(msg: dict) -> str:
+    # Conversation-manager messages carry "sender"; chat-style ones carry "role"
+    if msg.get("role") in ("user", "assistant"):
+        return msg["role"]
+    return "assistant" if msg.get("sender") == "character" else "user"
+
+def count_tokens(text: str) -> int:
+    if _enc is not None:
+        return len(_enc.encode(text))
+    return len(text) // 4 + 1
+
+def trim_history(history: list, budget: int = HISTORY_TOKEN_BUDGET, block: int = MEMORY_REFRESH_TURNS) -> list:
+    """Return the newest slice of history that fits in the token budget.
+
+    Old turns are dropped in whole blocks of `block` turns, so the first kept turn (and the
+    memory message built from it) only moves at block boundaries instead of every turn.
+    """
+    if not history:
+        return []
+    used = 0
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        used += count_tokens(history[i].get("content") or "")
+        if used > budget:
+            break
+        start = i
+    if start and block > 0:
+        start = -(-start // block) * block
+    return history[start:]
+
+def split_history(history: list):
+    """Split history into (memory_turns, recent_turns).
+
+    The memory cut point is aligned to MEMORY_REFRESH_TURNS so the memory block only
+    changes every few turns; the recent block holds the remaining (at least HISTORY_WINDOW) turns.
+    """
+    if not history:
+        return [], []
+    older = max(0, len(history) - HISTORY_WINDOW)
+    cutoff = older - older % MEMORY_REFRESH_TURNS if MEMORY_REFRESH_TURNS > 0 else older
+    return history[:cutoff], history[cutoff:]
+
+def build_memory_message(memory_turns: list):
+    if not memory_turns:
+        return None
+    lines = [f"{_history_role(msg)}: {(msg.get('content') or '')[:MEMORY_TURN_CHARS]}" for msg in memory_turns]
+    return {"role": "system", "content": "Earlier in this conversation:\n" + "\n".join(lines)}
+
+def _parse(response) -> dict:
+    # Single place for the getattr chains on a non-streamed completion
+    choice = response.choices[0] if getattr(response, "choices", None) else None
+    message = getattr(choice, "message", None)
+    return {
+        "reply": getattr(message, "content", None) or "",
+        "finish_reason": getattr(choice, "finish_reason", None),
+        "filter": getattr(choice, "content_filter_results", None),
+    }
+
+def _delta_text(chunk) -> str:
+    if not chunk.choices:
+        return ""
+    delta = getattr(chunk.choices[0], "delta", None)
+    return getattr(delta, "content", None) or ""
+
+def _is_rate_limited(e: Exception) -> bool:
+    return isinstance(e, RateLimitError) or (isinstance(e, APIStatusError) and e.status_code == 429)
+
+def _retry_after(e: Exception):
+    # Azure sends retry-after-ms and/or retry-after (seconds) on 429s
+    headers = getattr(getattr(e, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+def estimate_tokens(params: dict) -> int:
+    # Prompt tokens plus the completion cap; corrected from response usage when available
+    return sum(count_tokens(m.get("content") or "") for m in params["messages"]) + params.get("max_completion_tokens", 0)
+
+# Memoized (system, persona, rules) prefix per character; only the tail is built per call
+PREFIX_CACHE_SIZE = 1024
+_prefix_cache = OrderedDict()
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return ("dict", tuple(sorted((k, _freeze(v)) for k, v in value.items())))
+    if isinstance(value, (list, tuple)):
+        return ("list", tuple(_freeze(v) for v in value))
+    # Tag scalars with their type: True == 1 == 1.0 in Python but they render differently in the prompt
+    return (type(value).__name__, value)
+
+def build_system_prefix(persona_context: str, rules: dict = None):
+    """Return (prefix_messages, rules_version) for a persona, cached by content."""
+    try:
+        key = (persona_context, _freeze(rules) if rules else None)
+        hash(key)
+    except TypeError:
+        key = None
+    if key is not None:
+        cached = _prefix_cache.get(key)
+        if cached is not None:
+            _prefix_cache.move_to_end(key)
+            return cached
+    prefix = [
+        {"role": "system", "content": STATIC_SYSTEM_PROMPT},
         {"role": "system", "content": persona_context}
     ]
+    rules_version = None
     if rules:
-        messages.append({"role": "system", "content": f"Rules: {rules}"})
-    if history:
-        for msg in history:
-            role = "assistant" if msg.get("sender") == "character" else "user"
-            messages.append({"role": role, "content": msg.get("content")})
+        rules_str = canonical_json(rules)
+        rules_version = hashlib.md5(rules_str.encode()).hexdigest()[:8]
+        prefix.append({"role": "system", "content": f"Rules:{rules_str}"})
+    result = (tuple(prefix), rules_version)
+    if key is not None:
+        _prefix_cache[key] = result
+        if len(_prefix_cache) > PREFIX_CACHE_SIZE:
+            _prefix_cache.popitem(last=False)
+    return result
+
+def build_messages(user_query: str, persona_context: str, rules: dict = None, history: list = None):
+    # Stable blocks first (system, persona, rules), then memory, recent turns, and the query
+    prefix, rules_version = build_system_prefix(persona_context, rules)
+    messages = list(prefix)
+    memory_turns, recent_turns = split_history(trim_history(history))
+    memory_message = build_memory_message(memory_turns)
+    if memory_message:
+        messages.append(memory_message)
+    for msg in recent_turns:
+        messages.append({"role": _history_role(msg), "content": msg.get("content")})
     messages.append({"role": "user", "content": user_query})
-    logging.info(f"[LLM2] OpenAI API messages: {messages}")
+    return messages, rules_version
+
+async def _complete(params: dict) -> str:
+    start_time = asyncio.get_event_loop().time()
+    limiter = get_limiter(params["model"])
+    estimated = estimate_tokens(params)
+    await limiter.acquire(estimated)
+    try:
+        if not params["stream"]:
+            response = await client.chat.completions.create(**params)
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                limiter.record_usage(estimated, usage.total_tokens)
+            parsed = _parse(response)
+            full_reply = parsed["reply"]
+            if not full_reply:
+                # Usually a content-filter stop; retrying would return empty again
+                logging.warning(f"[LLM2] Empty reply: finish_reason={parsed['finish_reason']}, filter={parsed['filter']}")
+            logging.debug("[LLM2] Final: %r @ %.3fs", full_reply, asyncio.get_event_loop().time() - start_time)
+            return full_reply
+        response_stream = await client.chat.completions.create(**params)
+        full_reply = ""
+        async for chunk in response_stream:
+            text = _delta_text(chunk)
+            if text:
+                full_reply += text
+        limiter.record_usage(estimated, estimated - params["max_completion_tokens"] + count_tokens(full_reply))
+    except Exception as e:
+        if _is_rate_limited(e):
+            limiter.pause(_retry_after(e) or 1.0)
+        raise
+    finally:
+        limiter.release()
+    logging.debug("[LLM2] [stream] Final: %r @ %.3fs", full_reply, asyncio.get_event_loop().time() - start_time)
+    return full_reply
+
+async def _complete_coalesced(params: dict) -> str:
+    key = hashlib.sha1(canonical_json(params).encode()).hexdigest()
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_complete(params))
+        _inflight[key] = task
+        task.add_done_callback(lambda _t: _inflight.pop(key, None))
+    else:
+        logging.info(f"[LLM2] Coalescing duplicate in-flight request {key[:8]}")
+    # Shield so one cancelled caller does not cancel the call for the others
+    return await asyncio.shield(task)
+
+async def generate_response(user_query: str, persona_context: str, rules: dict = None, model: str = None, session_id: str = None, history: list = None, temperature: float = 1.0, top_p: float = 1.0, stream: bool = True):
+    logging.debug("[LLM2] generate_response called with session_id=%s, user_query=%s", session_id, user_query)
+    messages, rules_version = build_messages(user_query, persona_context, rules, history)
+    # Only stateless calls are cacheable: a session's reply depends on its conversation,
+    # even on a turn whose history happens to be empty
+    cache_namespace = None
+    if RESPONSE_CACHE_ENABLED and session_id is None and not history:
+        cache_namespace = hashlib.md5(f"{model}\x00{persona_context}\x00{rules_version}".encode()).hexdigest()
+        cached = response_cache.get(cache_namespace, user_query)
+        if cached is not None:
+            logging.info(f"[LLM2] Response cache hit (rules_version={rules_version})")
+            return {"response": cached}
+    logging.debug("[LLM2] OpenAI API messages (rules_version=%s): %s", rules_version, messages)
     max_retries = 5
     for attempt in range(max_retries):
         try:
-            logging.info(f"[LLM2] Sending to Azure: model={model or GPT4O_MINI_DEPLOYMENT}, messages={messages}")
             params = {
                 "messages": messages,
-                "max_completion_tokens": 64,
+                "max_completion_tokens": MAX_COMPLETION_TOKENS,
                 "model": model or GPT4O_MINI_DEPLOYMENT,
                 "temperature": 0.7,
                 "top_p": top_p,
-                "stream": True,
+                "stream": stream,
             }
-            logging.info(f"[LLM2] Outgoing OpenAI params: {params}")
-            start_time = asyncio.get_event_loop().time()
-            response_stream = await client.chat.completions.create(**params)
-            full_reply = ""
-            async for chunk in response_stream:
-                if not chunk.choices or len(chunk.choices) == 0:
-                    continue
-                delta = getattr(chunk.choices[0], 'delta', None)
-                if delta and hasattr(delta, 'content') and delta.content:
-                    full_reply += delta.content
-                    logging.info(f"[LLM2] [stream] Partial: {repr(full_reply)} @ {asyncio.get_event_loop().time() - start_time:.3f}s")
-            logging.info(f"[LLM2] [stream] Final: {repr(full_reply)} @ {asyncio.get_event_loop().time() - start_time:.3f}s")
+            logging.debug("[LLM2] Outgoing OpenAI params: %s", params)
+            full_reply = await _complete_coalesced(params)
+            if cache_namespace and full_reply:
+                response_cache.put(cache_namespace, user_query, full_reply)
             return {"response": full_reply}
         except Exception as e:
             err_str = str(e)
             logging.error(f"[LLM2] OpenAI call failed (attempt {attempt+1}/{max_retries}): {e}\n{traceback.format_exc()}")
-            if ("429" in err_str or "RateLimitError" in err_str):
+            if _is_rate_limited(e):
                 # Exponential backoff with jitter
                 base = 2
                 max_wait = 30
-                wait_time = min(max_wait, base ** attempt + random.uniform(0, 1))
+                wait_time = _retry_after(e) or min(max_wait, base ** attempt + random.uniform(0, 1))
                 logging.warning(f"[LLM2] Rate limit hit (429). Retrying after {wait_time:.2f} seconds... If this persists, consider upgrading your Azure OpenAI quota.")
                 await asyncio.sleep(wait_time)
                 if attempt < max_retries - 1:
@@ -91,4 +329,114 @@ async def generate_response(user_query: str, persona_context: str, rules: dict =
                 else:
                     logging.error("[LLM2] All retries exhausted due to rate limiting.")
                     return {"response": "Sorry, you are being rate limited by Azure OpenAI. Please wait and try again, or upgrade your quota at https://aka.ms/oai/quotaincrease.", "error": err_str}
-            return {"response": "Sorry, something went wrong.", "error": err_str} 
\ No newline at end of file
+            return {"response": "Sorry, something went wrong.", "error": err_str}
+
+async def stream_response(user_query: str, persona_context: str, rules: dict = None, model: str = None, session_id: str = None, history: list = None, top_p: float = 1.0):
+    """Async generator yielding reply text deltas as Azure streams them."""
+    logging.debug("[LLM2] stream_response called with session_id=%s, history=%d", session_id, len(history or ()))
+    messages, rules_version = build_messages(user_query, persona_context, rules, history)
+    params = {
+        "messages": messages,
+        "max_completion_tokens": MAX_COMPLETION_TOKENS,
+        "model": model or GPT4O_MINI_DEPLOYMENT,
+        "temperature": 0.7,
+        "top_p": top_p,
+        "stream": True,
+    }
+    sent_any = False
+    limiter = get_limiter(params["model"])
+    estimated = estimate_tokens(params)
+    try:
+        await limiter.acquire(estimated)
+        try:
+            response_stream = await client.chat.completions.create(**params)
+            reply_tokens = 0
+            async for chunk in response_stream:
+                text = _delta_text(chunk)
+                if text:
+                    sent_any = True
+                    reply_tokens += count_tokens(text)
+                    yield text
+            limiter.record_usage(estimated, estimated - MAX_COMPLETION_TOKENS + reply_tokens)
+        finally:
+            limiter.release()
+    except Exception as e:
+        if _is_rate_limited(e):
+            limiter.pause(_retry_after(e) or 1.0)
+        logging.error(f"[LLM2] [stream] OpenAI call failed (rules_version={rules_version}): {e}\n{traceback.format_exc()}")
+        if not sent_any:
+            yield "Sorry, something went wrong."
+
+async def submit_batch(items: list) -> dict:
+    # Offline traffic goes through the Azure Batch API: one JSONL upload, half the token price,
+    # and it does not count against the realtime deployment's rate limits.
+    # A batch job runs on exactly one deployment, so every line is pinned to BATCH_DEPLOYMENT.
+    overridden = {item["model"] for item in items if item.get("model") and item["model"] != BATCH_DEPLOYMENT}
+    if overridden:
+        logging.warning(f"[LLM2] Ignoring per-item model(s) {sorted(overridden)} in batch; using {BATCH_DEPLOYMENT}")
+    lines = []
+    for i, item in enumerate(items):
+        messages, _ = build_messages(item["user_query"], item["persona_context"], item.get("rules"))
+        lines.append(json.dumps({
+            "custom_id": item.get("custom_id") or str(i),
+            "method": "POST",
+            "url": "/chat/completions",
+            "body": {
+                "model": BATCH_DEPLOYMENT,
+                "messages": messages,
+                "max_completion_tokens": MAX_COMPLETION_TOKENS,
+                "temperature": 0.7,
+            },
+        }, separators=(",", ":")))
+    upload = await client.files.create(file=("llm2_batch.jsonl", "\n".join(lines).encode()), purpose="batch")
+    batch = await client.batches.create(input_file_id=upload.id, endpoint="/chat/completions", completion_window="24h")
+    logging.info(f"[LLM2] Submitted batch {batch.id} with {len(lines)} requests")
+    return {"batch_id": batch.id, "status": batch.status}
+
+def _batch_row_error(row: dict):
+    # Error message for a failed batch line, or None if it succeeded
+    if row.get("error"):
+        return (row["error"] or {}).get("message") or str(row["error"])
+    response = row.get("response") or {}
+    if response.get("status_code", 200) != 200:
+        body = response.get("body") or {}
+        return (body.get("error") or {}).get("message") or f"HTTP {response.get('status_code')}"
+    return None
+
+async def _batch_rows(file_id: str):
+    output = await client.files.content(file_id)
+    return [json.loads(line) for line in output.text.splitlines() if line.strip()]
+
+async def get_batch(batch_id: str) -> dict:
+    batch = await client.batches.retrieve(batch_id)
+    result = {"batch_id": batch.id, "status": batch.status}
+    # Failed lines go to a separate error file; report them so callers can tell them from missing ones
+    responses, errors = {}, {}
+    if batch.output_file_id:
+        for row in await _batch_rows(batch.output_file_id):
+            error = _batch_row_error(row)
+            if error:
+                errors[row["custom_id"]] = error
+                continue
+            body = (row.get("response") or {}).get("body") or {}
+            choices = body.get("choices") or [{}]
+            responses[row["custom_id"]] = (choices[0].get("message") or {}).get("content") or ""
+    if getattr(batch, "error_file_id", None):
+        for row in await _batch_rows(batch.error_file_id):
+            errors[row["custom_id"]] = _batch_row_error(row) or "failed"
+    if batch.output_file_id:
+        result["responses"] = responses
+    if errors:
+        result["errors"] = errors
+    return result
+
+async def warmup():
+    # Open the TLS connection (and resolve DNS) before the first user request pays for it
+    try:
+        await client.models.list()
+        logging.info("[LLM2] Azure OpenAI connection warmed up")
+    except Exception as e:
+        logging.warning(f"[LLM2] Azure OpenAI warmup failed: {e}")
+
+async def shutdown():
+    await client.close()
@@ -0,0 +1,35 @@
+# LLM2 Service Settings (read and validated once per process)
+
+from functools import lru_cache
+from pydantic import BaseSettings
+
+class Settings(BaseSettings):
+    # Field names map to upper-case env vars, e.g. azure_gpt4o_mini_api_key -> AZURE_GPT4O_MINI_API_KEY
+    azure_gpt4o_mini_endpoint: str = "https://ai-anuragpradeepjha5004ai785724618017.openai.azure.com/"
+    azure_gpt4o_mini_api_key: str
+    azure_gpt4o_mini_deployment: str = "gpt-4o-mini"
+    azure_gpt4o_mini_api_version: str = "2024-12-01-preview"
+
+    llm2_max_completion_tokens: int = 64
+    llm2_history_window: int = 6
+    llm2_memory_refresh_turns: int = 6
+    llm2_history_token_budget: int = 1500
+    llm_conc: int = 20
+    # Per-deployment Azure quota to stay under (0 = unlimited)
+    llm2_rpm: int = 0
+    llm2_tpm: int = 0
+    # Global-batch deployment used for offline /batch-response jobs
+    llm2_batch_deployment: str = "gpt-4o-mini"
+
+    llm2_response_cache: bool = True
+    llm2_response_cache_size: int = 256
+    llm2_response_cache_similarity: float = 0.9
+    # Longer queries must match a cached one exactly
+    llm2_response_cache_fuzzy_max_tokens: int = 4
+
+    internal_api_key: str = "changeme-internal-key"
+    log_level: str = "INFO"
+
+@lru_cache()
+def get_settings() -> Settings:
+    return Settings()
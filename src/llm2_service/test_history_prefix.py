@@ -0,0 +1,36 @@
+import os
+import re
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("openai")
+os.environ.setdefault("AZURE_GPT4O_MINI_API_KEY", "test-key")
+from fastapi.testclient import TestClient
+import main
+import service
+
+def test_history_is_trimmed_on_block_boundaries(monkeypatch):
+    sent = []
+    async def fake_complete(params):
+        sent.append(params["messages"])
+        return "ok"
+    monkeypatch.setattr(service, "_complete", fake_complete)
+    client = TestClient(main.app)
+    # Long turns so the token budget forces older turns out as the conversation grows
+    conversation = [{"sender": "user" if i % 2 == 0 else "character", "content": f"m{i} " + "lorem " * 80} for i in range(60)]
+    for turn in range(1, 31):
+        resp = client.post(
+            "/generate-response",
+            headers={"x-internal-api-key": main.INTERNAL_API_KEY},
+            json={"user_query": f"q{turn}", "persona_context": "persona", "rules": {}, "history": conversation[:2 * turn], "session_id": "s1"},
+        )
+        assert resp.status_code == 200
+    starts = []
+    for messages in sent:
+        history_text = "\n".join(m["content"] for m in messages[2:-1])
+        kept = [int(n) for n in re.findall(r"\bm(\d+) ", history_text)]
+        assert kept, "history did not reach the prompt"
+        starts.append(min(kept))
+    assert max(starts) > 0
+    # The oldest kept turn only ever moves by whole blocks
+    assert all(start % service.MEMORY_REFRESH_TURNS == 0 for start in starts)
@@ -0,0 +1,36 @@
+import asyncio
+import time
+from rate_limiter import TokenBucket, EndpointLimiter
+
+def test_token_bucket_waits_for_refill():
+    async def run():
+        bucket = TokenBucket(capacity=10, period=1.0)
+        await bucket.acquire(10)
+        start = time.monotonic()
+        await bucket.acquire(2)
+        return time.monotonic() - start
+    assert asyncio.run(run()) >= 0.15
+
+def test_usage_feedback_refunds_estimate():
+    bucket = TokenBucket(capacity=100, period=60.0)
+    bucket.tokens = 0
+    bucket.adjust(-40)
+    assert 40 <= bucket.tokens < 41
+
+def test_limiter_caps_concurrency():
+    async def run():
+        limiter = EndpointLimiter(concurrency=2)
+        active = peak = 0
+        async def call():
+            nonlocal active, peak
+            await limiter.acquire()
+            try:
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.01)
+                active -= 1
+            finally:
+                limiter.release()
+        await asyncio.gather(*(call() for _ in range(6)))
+        return peak
+    assert asyncio.run(run()) == 2
@@ -0,0 +1,28 @@
+from response_cache import ResponseCache
+
+def test_exact_and_similar_hits():
+    cache = ResponseCache(threshold=0.75, fuzzy_max_tokens=6)
+    cache.put("alice", "Hello there, how are you?", "I'm great!")
+    assert cache.get("alice", "hello there how are you") == "I'm great!"
+    assert cache.get("alice", "hello there how are you today") == "I'm great!"
+    assert cache.get("alice", "what is the weather") is None
+
+def test_namespaces_are_isolated():
+    cache = ResponseCache()
+    cache.put("alice", "hi", "Hi from Alice")
+    assert cache.get("bob", "hi") is None
+
+def test_lru_eviction():
+    cache = ResponseCache(max_entries=2, threshold=1.0)
+    cache.put("alice", "one", "1")
+    cache.put("alice", "two", "2")
+    cache.get("alice", "one")
+    cache.put("alice", "three", "3")
+    assert cache.get("alice", "two") is None
+    assert cache.get("alice", "one") == "1"
+
+def test_long_queries_need_exact_match():
+    cache = ResponseCache(threshold=0.75)
+    cache.put("alice", "Please tell me why I should do the dishes tonight", "Because it's your turn.")
+    assert cache.get("alice", "please tell me why I should do the dishes tonight") == "Because it's your turn."
+    assert cache.get("alice", "Please tell me why I shouldn't do the dishes tonight") is None
@@ -1,13 +1,19 @@
-import requests
+import httpx
 
 class LLamaClient:
     def __init__(self, endpoint, api_key):
         self.endpoint = endpoint
         self.api_key = api_key
+        # One pooled client per LLamaClient so TCP/TLS connections are reused across calls
+        self._client = httpx.AsyncClient(
+            base_url=endpoint,
+            http2=True,
+            timeout=30,
+            limits=httpx.Limits(max_keepalive_connections=50),
+            headers={"Authorization": f"Bearer {api_key}"},
+        )
 
-    def generate_response(self, messages):
-        url = f"{self.endpoint}/openai/deployments/llama/chat/completions"
-        headers = {"Authorization": f"Bearer {self.api_key}"}
+    async def generate_response(self, messages):
         payload = {
             "messages": messages,
             "temperature": 0.7,
@@ -16,6 +22,9 @@ class LLamaClient:
             "frequency_penalty": 0,
             "presence_penalty": 0
         }
-        response = requests.post(url, json=payload, headers=headers)
+        response = await self._client.post("/openai/deployments/llama/chat/completions", json=payload)
         response.raise_for_status()
-        return response.json()
\ No newline at end of file
+        return response.json()
+
+    async def aclose(self):
+        await self._client.aclose()
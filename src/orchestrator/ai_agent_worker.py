@@ -1,21 +1,34 @@
 import os
 import asyncio
 import logging
+import math
 import jwt
 import time
+from collections import deque
 from livekit import rtc
-from service import generate_response
-import torch
-from silero_vad import VoiceActivityDetector, read_audio
+from service import http_client, safe_post, response_json, stream_tts, LLM2_FALLBACK, LLM2_MODEL
+from speech.vad import StreamingVAD
 import websockets
-import httpx
-import base64
+import numpy as np
+import orjson
 
 LIVEKIT_URL = os.getenv("LIVEKIT_URL", "ws://livekit:7880")
 LIVEKIT_API_KEY = os.getenv("LIVEKIT_API_KEY", "your_livekit_api_key")
 LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET", "your_livekit_api_secret")
 
 AI_USER_ID = "ai-agent"
+AGENT_PERSONA_CONTEXT = "You are a helpful AI assistant."
+AGENT_RULES = {"persona": "default", "style": "default", "forbidden_topics": [], "voice_type": "predefined"}
+TTS_SAMPLE_RATE = 16000
+DEEPGRAM_API_KEY = os.getenv("DEEPGRAM_API_KEY")
+DEEPGRAM_URL = "wss://api.deepgram.com/v1/listen"
+DEEPGRAM_SEND_BYTES = 3200  # ~0.1s of 16kHz 16-bit mono PCM per send
+DEEPGRAM_KEEPALIVE_S = 5
+DEEPGRAM_FINAL_MARKER = '"is_final":true'
+DEEPGRAM_FINALIZE_MARKER = '"from_finalize":true'
+DEEPGRAM_FINALIZE_TIMEOUT_S = 2.0
+DEEPGRAM_RECONNECT_ATTEMPTS = 3
+DEEPGRAM_RECONNECT_DELAY_S = 0.5
 
 # Helper to generate a LiveKit JWT for the AI agent
 def generate_livekit_token(user_id, room_name):
@@ -37,9 +50,67 @@ def generate_livekit_token(user_id, room_name):
     token = jwt.encode(payload, LIVEKIT_API_SECRET, algorithm="HS256")
     return token
 
-# Initialize Silero VAD
-vad_model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad', model='silero_vad', force_reload=False)
-(get_speech_timestamps, save_audio, read_audio, VADIterator, collect_chunks) = utils
+async def connect_deepgram():
+    # websockets directly (no httpx layer); permessage-deflate off since PCM does not compress
+    return await websockets.connect(
+        DEEPGRAM_URL,
+        additional_headers={"Authorization": f"Token {DEEPGRAM_API_KEY}"},
+        compression=None,
+        max_size=None,
+    )
+
+# WebRTC VAD for barge-in: 30 ms frames of PCM16 mono 16 kHz, no neural net on the audio loop
+barge_in_vad = StreamingVAD(sample_rate=16000, frame_ms=30, aggressiveness=2)
+
+# Energy gate in front of the VAD: chunks near the adaptive noise floor are rejected without running it
+ENERGY_GATE_RATIO = 3.0
+NOISE_FLOOR_ALPHA = 0.01
+noise_floor = 0.0015  # RMS of [-1, 1] samples (~50 in int16); adapts to the room within a few seconds
+
+def _vad_prefilter(samples, noise_floor, alpha, ratio):
+    """Returns (passes_gate, rms, updated_noise_floor) for an int16 chunk."""
+    # Vectorized int16 -> float32 in [-1, 1); np.dot does the sum of squares without a temp array
+    f = samples.astype(np.float32)
+    f *= 1.0 / 32768.0
+    rms = math.sqrt(float(np.dot(f, f)) / f.size)
+    if rms < ratio * noise_floor:
+        return False, rms, noise_floor + alpha * (rms - noise_floor)
+    return True, rms, noise_floor
+
+# Optional numba dependency: compiles the prefilter to a single fused loop with no interpreter in it
+try:
+    import numba
+
+    @numba.njit(fastmath=True, cache=True)
+    def _vad_prefilter(samples, noise_floor, alpha, ratio):
+        acc = 0.0
+        for i in range(samples.size):
+            x = samples[i] / 32768.0
+            acc += x * x
+        rms = math.sqrt(acc / samples.size)
+        if rms < ratio * noise_floor:
+            return False, rms, noise_floor + alpha * (rms - noise_floor)
+        return True, rms, noise_floor
+except ImportError:
+    pass
+
+def is_speech(audio_chunk):
+    # audio_chunk: bytes, PCM 16kHz mono; True on the first speech frame
+    global noise_floor
+    samples = np.frombuffer(audio_chunk, dtype=np.int16, count=len(audio_chunk) // 2)
+    if not samples.size:
+        return False
+    passes, rms, noise_floor = _vad_prefilter(samples, noise_floor, NOISE_FLOOR_ALPHA, ENERGY_GATE_RATIO)
+    if not passes:
+        return False
+    frame_bytes = barge_in_vad.frame_bytes
+    view = memoryview(audio_chunk)
+    for start in range(0, len(view) - frame_bytes + 1, frame_bytes):
+        if barge_in_vad.vad.is_speech(view[start:start + frame_bytes].tobytes(), barge_in_vad.sample_rate):
+            return True
+    # Loud but not speech (fan, traffic): let the floor rise so the gate catches it next time
+    noise_floor += NOISE_FLOOR_ALPHA * (rms - noise_floor)
+    return False
 
 async def run_ai_agent(room_name):
     """
@@ -51,10 +122,45 @@ async def run_ai_agent(room_name):
 
     tts_audio_track = None  # Track for current TTS playback
     tts_playing = False
+    tts_task = None  # Playback of the current reply; cancelled on barge-in
+
+    async def play_reply(ai_text):
+        # Runs as its own task so on_track keeps reading Deepgram results (and can barge in) while audio plays
+        nonlocal tts_audio_track, tts_playing
+        # Publish the track up front and feed PCM as it is synthesized,
+        # so playback starts at the first chunk instead of after full synthesis
+        audio_source = rtc.AudioSource(TTS_SAMPLE_RATE, 1)
+        tts_audio_track = rtc.LocalAudioTrack.create_audio_track("tts", audio_source)
+        tts_playing = True
+        try:
+            await room.local_participant.publish_track(tts_audio_track)
+            logging.debug("[AI_AGENT] Published TTS audio track for response.")
+            leftover = b""
+            async def on_pcm(pcm_chunk):
+                nonlocal leftover
+                # HTTP chunks can split a 16-bit sample; carry the odd byte over
+                pcm = leftover + pcm_chunk
+                samples = len(pcm) // 2
+                leftover = pcm[samples * 2:]
+                if samples:
+                    await audio_source.capture_frame(rtc.AudioFrame(pcm[:samples * 2], TTS_SAMPLE_RATE, 1, samples))
+            # Synthesis goes through the TTS service over HTTP; the orchestrator image does not ship tts_service
+            tts_status = await stream_tts(http_client, ai_text, AGENT_RULES["voice_type"], on_pcm, output_format=f"pcm_{TTS_SAMPLE_RATE}")
+            if tts_status != 200:
+                logging.error(f"[AI_AGENT] TTS stream failed with status {tts_status}")
+            await audio_source.wait_for_playout()
+        finally:
+            # Finished or barged in: take the track down so the next utterance gets a reply
+            try:
+                await room.local_participant.unpublish_track(tts_audio_track.sid)
+            except Exception as e:
+                logging.warning(f"[AI_AGENT] Could not unpublish TTS track: {e}")
+            tts_audio_track = None
+            tts_playing = False
 
     @room.on("track_subscribed")
     async def on_track(track, publication, participant):
-        nonlocal tts_audio_track, tts_playing
+        nonlocal tts_task
         if track.kind == "audio":
             logging.info(f"[AI_AGENT] Subscribed to audio from {participant.identity}")
             # Stream audio to Deepgram STT
@@ -62,79 +168,134 @@ async def run_ai_agent(room_name):
                 # VAD: Check if user is speaking (barge-in)
                 if tts_playing and is_speech(audio_chunk):
                     logging.info(f"[AI_AGENT] Barge-in detected, stopping TTS audio.")
-                    if tts_audio_track:
-                        await room.local_participant.unpublish_track(tts_audio_track)
-                        tts_audio_track = None
-                        tts_playing = False
-                logging.info(f"[AI_AGENT] Transcript: {transcript}")
+                    tts_task.cancel()
+                if transcript:
+                    logging.debug("[AI_AGENT] Transcript: %s", transcript)
                 # Streaming/low-latency: As soon as transcript is "final enough", respond
-                if transcript and not tts_playing:
-                    persona_context = "You are a helpful AI assistant."
-                    rules = {"persona": "default", "style": "default", "forbidden_topics": [], "voice_type": "predefined"}
-                    llm_result = await generate_response(transcript, persona_context, rules)
-                    ai_text = llm_result["response"]
-                    logging.info(f"[AI_AGENT] LLM response: {ai_text}")
-                    from tts_service.service import text_to_speech
-                    audio_bytes = await text_to_speech(ai_text, rules.get("voice_type", "predefined"))
-                    tts_audio_track = rtc.LocalAudioTrack(audio_bytes)
-                    await room.local_participant.publish_track(tts_audio_track)
-                    tts_playing = True
-                    logging.info(f"[AI_AGENT] Published TTS audio track for response.")
-
-    # Helper: VAD on audio chunk
-    def is_speech(audio_chunk):
-        # audio_chunk: bytes, PCM 16kHz mono
-        import numpy as np
-        import soundfile as sf
-        import io
-        try:
-            # Convert bytes to numpy array
-            audio_np, sr = sf.read(io.BytesIO(audio_chunk), dtype='int16')
-            speech_timestamps = get_speech_timestamps(audio_np, vad_model, sampling_rate=sr)
-            return bool(speech_timestamps)
-        except Exception as e:
-            logging.error(f"VAD error: {e}")
-            return False
+                if transcript and (tts_task is None or tts_task.done()):
+                    # Stateless call (no session, no history) to LLM2's /generate-response, where repeated
+                    # utterances are answered from its per-persona response cache instead of a new completion
+                    llm2_resp = await safe_post(http_client, "llm2", {"persona_context": AGENT_PERSONA_CONTEXT, "rules": AGENT_RULES, "model": LLM2_MODEL, "user_query": transcript}, fallback=LLM2_FALLBACK, step_name="LLM2")
+                    ai_text = response_json(llm2_resp).get("response", LLM2_FALLBACK["response"])
+                    logging.debug("[AI_AGENT] LLM response: %s", ai_text)
+                    tts_task = asyncio.create_task(play_reply(ai_text))
 
     # Helper: Stream Deepgram with audio chunk yield
     async def stream_deepgram_with_audio(track):
         """
-        Streams audio from LiveKit track to Deepgram, yields (partial transcript, audio_chunk) pairs.
+        Streams audio from a LiveKit track to its own Deepgram socket, yields (partial transcript, audio_chunk) pairs.
+        One connection and result queue per track, so participants' audio and transcripts never mix.
         """
-        import numpy as np
-        import soundfile as sf
-        import io
-        import json
-        import asyncio
-        import httpx
-        import websockets
-
-        DEEPGRAM_API_KEY = os.getenv("DEEPGRAM_API_KEY")
-        DEEPGRAM_URL = "wss://api.deepgram.com/v1/listen"
-        headers = {"Authorization": f"Token {DEEPGRAM_API_KEY}"}
-
-        # Buffer for partial audio
-        audio_buffer = b""
-        chunk_size = 3200  # ~0.1s of 16kHz 16-bit mono PCM
-        async with httpx.AsyncClient() as client:
-            async with client.ws_connect(DEEPGRAM_URL, headers=headers) as ws:
+        # Coalesce track chunks into ~100 ms frames so each WebSocket send carries a useful payload;
+        # chunks are kept as-is and joined once per send instead of being copied into a growing buffer
+        audio_chunks = deque()
+        buffered = 0
+        results = asyncio.Queue()
+        track_done = object()
+        track_ended = False
+        finalized = asyncio.Event()
+        last_frame = b""
+        last_send = time.monotonic()
+        dg_ws = await connect_deepgram()
+
+        # Upload and transcript reception run independently; Deepgram answers asynchronously,
+        # so waiting for a reply after every send would stall the audio upload.
+        async def sender():
+            nonlocal last_frame, last_send, buffered, track_ended
+            try:
                 async for audio_chunk in track:
                     # audio_chunk: bytes, PCM 16kHz mono
-                    audio_buffer += audio_chunk
-                    await ws.send_bytes(audio_chunk)
-                    # VAD/barge-in: yield each chunk for VAD
+                    audio_chunks.append(audio_chunk)
+                    buffered += len(audio_chunk)
+                    if buffered < DEEPGRAM_SEND_BYTES:
+                        continue
+                    last_frame = b"".join(audio_chunks)
+                    audio_chunks.clear()
+                    buffered = 0
+                    try:
+                        await dg_ws.send(last_frame)
+                        last_send = time.monotonic()
+                    except websockets.ConnectionClosed:
+                        pass  # receiver is reconnecting; this frame is lost
+                track_ended = True
+                if audio_chunks:
+                    await dg_ws.send(b"".join(audio_chunks))
+                # Flush the last utterance and wait for its result before closing the stream
+                await dg_ws.send('{"type": "Finalize"}')
+                try:
+                    await asyncio.wait_for(finalized.wait(), DEEPGRAM_FINALIZE_TIMEOUT_S)
+                except asyncio.TimeoutError:
+                    logging.warning("[AI_AGENT] No Finalize result from Deepgram, closing stream anyway")
+                await dg_ws.send('{"type": "CloseStream"}')
+            except Exception as e:
+                logging.error(f"Deepgram streaming error: {e}")
+                track_ended = True
+                await dg_ws.close()
+
+        async def receiver():
+            # Ends the track only once the socket is closed, so every result is queued before track_done
+            nonlocal dg_ws
+            attempts = 0
+            try:
+                while True:
+                    try:
+                        async for raw in dg_ws:
+                            attempts = 0
+                            # Interim results are only needed to drive barge-in VAD; skip decoding them
+                            transcript = ""
+                            if DEEPGRAM_FINAL_MARKER in raw or DEEPGRAM_FINALIZE_MARKER in raw:
+                                msg = orjson.loads(raw)
+                                if msg.get("is_final"):
+                                    transcript = msg.get("channel", {}).get("alternatives", [{}])[0].get("transcript", "")
+                                if msg.get("from_finalize"):
+                                    finalized.set()
+                            # Pair each result with the latest frame sent for barge-in VAD
+                            await results.put((transcript, last_frame))
+                    except websockets.ConnectionClosed as e:
+                        logging.info(f"[AI_AGENT] Deepgram stream closed: {e}")
+                    if track_ended:
+                        return
+                    # Deepgram dropped the socket mid-track: reconnect and keep streaming
+                    attempts += 1
+                    if attempts > DEEPGRAM_RECONNECT_ATTEMPTS:
+                        logging.error("[AI_AGENT] Giving up on Deepgram after repeated reconnect failures")
+                        return
+                    await asyncio.sleep(DEEPGRAM_RECONNECT_DELAY_S * attempts)
                     try:
-                        msg = await ws.receive_json()
-                        transcript = msg.get("channel", {}).get("alternatives", [{}])[0].get("transcript", "")
-                        yield (transcript, audio_chunk)
+                        dg_ws = await connect_deepgram()
                     except Exception as e:
-                        logging.error(f"Deepgram streaming error: {e}")
-                        continue
-                await ws.aclose()
+                        logging.error(f"[AI_AGENT] Deepgram reconnect failed: {e}")
+            finally:
+                results.put_nowait(track_done)
+
+        async def keepalive():
+            # Deepgram closes a stream after ~10s without audio; keep the socket open while the track is muted
+            while True:
+                await asyncio.sleep(DEEPGRAM_KEEPALIVE_S)
+                if time.monotonic() - last_send >= DEEPGRAM_KEEPALIVE_S:
+                    try:
+                        await dg_ws.send('{"type": "KeepAlive"}')
+                    except websockets.ConnectionClosed:
+                        pass
+
+        tasks = [asyncio.create_task(sender()), asyncio.create_task(receiver()), asyncio.create_task(keepalive())]
+        try:
+            while True:
+                item = await results.get()
+                if item is track_done:
+                    break
+                yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+            await dg_ws.close()
 
-    # Keep the agent running
-    while True:
-        await asyncio.sleep(1)
+    # Keep the agent running until the room goes away; no periodic timer wake-ups
+    disconnected = asyncio.Event()
+    room.on("disconnected", lambda *args: disconnected.set())
+    await disconnected.wait()
+    if tts_task is not None:
+        tts_task.cancel()
 
 # Entry point for running the agent (for testing)
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+# Per-backend backpressure for the orchestrator: adaptive concurrency limit plus circuit breaker
+
+import asyncio
+import time
+from collections import deque
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit (like TCP congestion control): an overloaded call (5xx, timeout, connect
+    failure) halves the limit, and a full window of successes (as many as the current limit) adds one.
+    """
+    def __init__(self, initial: int = 32, minimum: int = 4, maximum: int = 256):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self._waiters = deque()
+
+    async def acquire(self):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we were cancelled; pass it on
+                self._release_slot()
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self, overloaded: bool = False):
+        if overloaded:
+            self.limit = max(self.minimum, self.limit // 2)
+            self.successes = 0
+        else:
+            self.successes += 1
+            if self.successes >= self.limit:
+                self.limit = min(self.maximum, self.limit + 1)
+                self.successes = 0
+        self._release_slot()
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+class CircuitBreaker:
+    """
+    CLOSED -> OPEN after `failure_threshold` consecutive failures; after `reset_timeout` seconds a
+    single HALF_OPEN probe is let through, and its result closes or re-opens the circuit.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self.probe_started = now
+            return True
+        # HALF_OPEN: one probe at a time, unless the last one never reported back
+        if now - self.probe_started >= self.reset_timeout:
+            self.probe_started = now
+            return True
+        return False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        return self.state == self.OPEN
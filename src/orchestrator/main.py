@@ -1,25 +1,81 @@
-from dotenv import load_dotenv
 import os
-from fastapi import FastAPI, HTTPException, Request, status, WebSocket, WebSocketDisconnect
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request, status, WebSocket
+from pydantic import BaseModel, root_validator
 from typing import Optional
-from service import orchestrate_interaction, router as voice_router
-from voice_ws import router as voice_ws_router
 import logging
+import logging.handlers
+import queue
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
-import httpx
+from fastapi.responses import ORJSONResponse, StreamingResponse
 import time
 import uuid
-import webrtcvad
 import asyncio
-import json
 import sys
+import re
+import traceback
+import random
+from contextvars import ContextVar
 
-logging.basicConfig(level=logging.INFO)
+# Correlation ID of the request being served; set by the log_requests middleware
+REQUEST_ID: ContextVar[str] = ContextVar("request_id", default="-")
+# W3C trace context: version-traceid-parentid-flags
+TRACEPARENT_RE = re.compile(r"[0-9a-f]{2}-([0-9a-f]{32})-[0-9a-f]{16}-[0-9a-f]{2}")
+REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = REQUEST_ID.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes every WARNING+ record (and any logged with extra={"sample": "always"}); DEBUG/INFO are
+    kept with probability 1 / max(1, qps / base_qps), where qps is the request rate of the last second.
+    """
+    def __init__(self, base_qps: float):
+        super().__init__()
+        self.base_qps = base_qps
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.keep_ratio = 1.0
+
+    def observe_request(self):
+        now = time.monotonic()
+        if now - self.window_start >= 1.0:
+            qps = self.window_count / (now - self.window_start)
+            self.keep_ratio = 1.0 / max(1.0, qps / self.base_qps)
+            self.window_start = now
+            self.window_count = 0
+        self.window_count += 1
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or getattr(record, "sample", None) == "always":
+            return True
+        return self.keep_ratio >= 1.0 or random.random() < self.keep_ratio
+
+# Above LOG_SAMPLE_QPS requests/s, DEBUG/INFO lines are sampled down proportionally
+log_sampler = SamplingFilter(float(os.getenv("LOG_SAMPLE_QPS", "100")))
+
+def configure_logging():
+    # Handlers run on a QueueListener thread; request/audio paths only enqueue the record
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(levelname)s:%(name)s:[request_id=%(request_id)s] %(message)s"))
+    # The context var is only visible on the calling thread, so stamp the record before it is queued
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(log_sampler)
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+log_listener = configure_logging()
 logger = logging.getLogger("orchestrator")
 
-app = FastAPI(title="AI Orchestrator Service")
+app = FastAPI(title="AI Orchestrator Service", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -33,23 +89,18 @@ app.add_middleware(
 print("[STARTUP] main.py loaded", file=sys.stderr)
 
 try:
-    from service import orchestrate_interaction, router as voice_router
-    print("[STARTUP] service router loaded", file=sys.stderr)
-except Exception as e:
-    print(f"[STARTUP ERROR] service import failed: {e}", file=sys.stderr)
-    raise
-
-try:
+    from service import orchestrate_interaction, http_client, llm1_context_cache, llm1_cache_stats, router as voice_router
     from voice_ws import router as voice_ws_router
-    print("[STARTUP] voice_ws router loaded", file=sys.stderr)
 except Exception as e:
-    print(f"[STARTUP ERROR] voice_ws import failed: {e}", file=sys.stderr)
+    print(f"[STARTUP ERROR] router import failed: {e}", file=sys.stderr)
     raise
 
 app.include_router(voice_router)
-print("[STARTUP] Registered voice_router", file=sys.stderr)
 app.include_router(voice_ws_router)
-print("[STARTUP] Registered voice_ws_router", file=sys.stderr)
+print("[STARTUP] Registered voice_router, voice_ws_router", file=sys.stderr)
+
+BASE64_RE = re.compile(r"[A-Za-z0-9+/]*={0,2}")
+INVALID_AUDIO_DETAIL = "audio_data must be valid base64-encoded PCM bytes for voice mode."
 
 class OrchestratorRequest(BaseModel):
     user_input: str
@@ -57,10 +108,18 @@ class OrchestratorRequest(BaseModel):
     mode: str  # 'chat' or 'voice'
     audio_data: Optional[str] = None  # base64, for voice mode
 
+    @root_validator(skip_on_failure=True)
+    def require_input(cls, values):
+        # Rejected by FastAPI (422) before the handler runs
+        if not (values.get("user_input") or "").strip() and not (values.get("audio_data") or "").strip():
+            raise ValueError("Either user_input (text) or audio_data (voice) must be provided.")
+        return values
+
 class OrchestratorResponse(BaseModel):
     response: str
     audio_data: Optional[str] = None
 
+INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY", "changeme-internal-key")
 ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 if not ELEVENLABS_API_KEY:
     print("[ORCHESTRATOR] WARNING: ELEVENLABS_API_KEY not set!", flush=True)
@@ -78,94 +137,110 @@ async def interact(req: OrchestratorRequest, request: Request):
     - For voice: send {audio_data: base64-encoded PCM 16kHz mono, character_details: dict, mode: "voice"}
     At least one of user_input or audio_data must be provided.
     """
-    request_id = getattr(request.state, 'request_id', 'unknown')
-    logger.info(f"[request_id={request_id}] /interact payload: user_input length={len(req.user_input)}, character_details keys={list(req.character_details.keys())}, mode={req.mode}, audio_data length={len(req.audio_data) if req.audio_data else 0}")
-    import traceback
-    # Strict input validation
-    errors = []
-    if not isinstance(req.user_input, str):
-        errors.append("user_input must be a string")
-    if not isinstance(req.character_details, dict):
-        errors.append("character_details must be an object")
-    if not isinstance(req.mode, str):
-        errors.append("mode must be a string")
-    if req.audio_data is not None and not isinstance(req.audio_data, str):
-        errors.append("audio_data must be a string or null")
-    if (not req.user_input or len(req.user_input.strip()) == 0) and (not req.audio_data or len(req.audio_data.strip()) == 0):
-        errors.append("Either user_input (text) or audio_data (voice) must be provided.")
+    request_id = REQUEST_ID.get()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"/interact payload: user_input length={len(req.user_input)}, character_details keys={list(req.character_details.keys())}, mode={req.mode}, audio_data length={len(req.audio_data) if req.audio_data else 0}")
+    # Types and the user_input/audio_data rule are enforced by OrchestratorRequest
     # If mode is voice, check audio_data is valid base64
-    if req.mode == "voice" and req.audio_data:
-        import base64
-        try:
-            base64.b64decode(req.audio_data)
-        except Exception:
-            errors.append("audio_data must be valid base64-encoded PCM bytes for voice mode.")
-    if errors:
-        logger.error(f"[request_id={request_id}] Validation error(s) in /interact: {errors}")
-        return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"detail": errors})
+    audio_data = req.audio_data
+    if req.mode == "voice" and audio_data:
+        # One full shape check (alphabet + padding) without decoding; STT's decoder would silently skip bad characters
+        audio_data = "".join(audio_data.split())  # line-wrapped (MIME style) base64 is accepted
+        if len(audio_data) % 4 or not BASE64_RE.fullmatch(audio_data):
+            logger.error("Validation error in /interact: audio_data is not base64")
+            return ORJSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content={"detail": [INVALID_AUDIO_DETAIL]})
     try:
         result = await orchestrate_interaction(
             user_input=req.user_input,
             character_details=req.character_details,
             mode=req.mode,
-            audio_data=req.audio_data
+            audio_data=audio_data,
+            request_id=request_id,
+            client=http_client,
         )
-        logger.info(f"[request_id={request_id}] /interact response: response length={len(result.get('response',''))}, audio_data length={len(result.get('audio_data') or '')}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"/interact response: response length={len(result.get('response',''))}, audio_data length={len(result.get('audio_data') or '')}")
         if result.get("error"):
-            return JSONResponse(status_code=500, content={"response": result.get("response", "Sorry, something went wrong."), "audio_data": result.get("audio_data"), "error": result["error"]})
+            return ORJSONResponse(status_code=500, content={"response": result.get("response", "Sorry, something went wrong."), "audio_data": result.get("audio_data"), "error": result["error"]})
         return OrchestratorResponse(**result)
     except Exception as e:
-        logger.error(f"[request_id={request_id}] Exception in /interact: {e}")
+        logger.error(f"Exception in /interact: {e}")
         logger.error(traceback.format_exc())
-        return JSONResponse(status_code=500, content={"response": "Sorry, something went wrong.", "audio_data": None, "error": {"exception": str(e)}})
+        return ORJSONResponse(status_code=500, content={"response": "Sorry, something went wrong.", "audio_data": None, "error": {"exception": str(e)}})
+
+# Downstream health endpoints
+HEALTH_URLS = {
+    "llm1": "http://llm1_service:8001/health",
+    "llm2": "http://llm2_service:8002/health",
+    "stt": "http://stt_service:8003/health",
+    "tts": "http://tts_service:8004/health",
+}
+
+async def probe_health(name, url):
+    try:
+        resp = await http_client.get(url, timeout=2.0)
+        return name, "ok" if resp.status_code == 200 else f"error: {resp.text}"
+    except Exception as e:
+        return name, f"error: {str(e)}"
 
 @app.get("/health")
 async def health():
-    # Check downstream services
-    services = {
-        "llm1": "http://llm1_service:8001/health",
-        "llm2": "http://llm2_service:8002/health",
-        "stt": "http://stt_service:8003/health",
-        "tts": "http://tts_service:8004/health",
-    }
-    results = {}
-    unhealthy = []
-    async with httpx.AsyncClient(timeout=2.0) as client:
-        for name, url in services.items():
-            try:
-                resp = await client.get(url)
-                if resp.status_code == 200:
-                    results[name] = "ok"
-                else:
-                    results[name] = f"error: {resp.text}"
-                    unhealthy.append(name)
-            except Exception as e:
-                results[name] = f"error: {str(e)}"
-                unhealthy.append(name)
+    # Probes are independent; total latency is the slowest one, not the sum
+    results = dict(await asyncio.gather(*(probe_health(name, url) for name, url in HEALTH_URLS.items())))
+    unhealthy = [name for name, result in results.items() if result != "ok"]
     status_code = 200 if not unhealthy else 500
     if unhealthy:
         logger.warning(f"[Orchestrator] /health: unhealthy services: {unhealthy}")
     return {"status": "ok" if not unhealthy else "error", "unhealthy": unhealthy, "services": results}, status_code
 
+@app.get("/metrics")
+async def metrics():
+    # Per-worker counters; scrape each worker (or aggregate) when running several
+    return {"llm1_context_cache": {"size": len(llm1_context_cache), **llm1_cache_stats}}
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+    log_listener.stop()
+
 @app.options("/interact")
 async def options_interact():
-    return JSONResponse(status_code=200, content={})
+    return ORJSONResponse(status_code=200, content={})
+
+def incoming_request_id(request: Request) -> str:
+    # Keep the caller's trace id so logs line up across services; otherwise mint one
+    traceparent = TRACEPARENT_RE.fullmatch(request.headers.get("traceparent", ""))
+    if traceparent:
+        return traceparent.group(1)
+    # Client-supplied ids end up in logs and response headers: only accept a short, plain token
+    request_id = request.headers.get("x-request-id", "")
+    if REQUEST_ID_RE.fullmatch(request_id):
+        return request_id
+    return str(uuid.uuid4())
+
+def trace_headers(request: Request) -> dict:
+    headers = {"x-request-id": REQUEST_ID.get()}
+    if "traceparent" in request.headers:
+        headers["traceparent"] = request.headers["traceparent"]
+    return headers
 
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    request_id = str(uuid.uuid4())
-    request.state.request_id = request_id
-    logger.info(f"[request_id={request_id}] Request: {request.method} {request.url}")
+    token = REQUEST_ID.set(incoming_request_id(request))
+    log_sampler.observe_request()
+    logger.debug("Request: %s %s", request.method, request.url)
     start = time.time()
     try:
         response = await call_next(request)
         latency = (time.time() - start) * 1000
-        logger.info(f"[request_id={request_id}] Response status: {response.status_code} | Latency: {latency:.2f}ms")
+        logger.info("%s %s -> %s | Latency: %.2fms", request.method, request.url.path, response.status_code, latency)
+        response.headers["x-request-id"] = REQUEST_ID.get()
         return response
     except Exception as e:
-        import traceback
-        logger.error(f"[request_id={request_id}] Error: {e}\n{traceback.format_exc()}")
-        raise 
+        logger.error(f"Error: {e}\n{traceback.format_exc()}")
+        raise
+    finally:
+        REQUEST_ID.reset(token)
 
 @app.post("/stream-speech-to-text")
 async def stream_speech_to_text(request: Request):
@@ -175,49 +250,47 @@ async def stream_speech_to_text(request: Request):
     - Proxies the stream to the STT service and streams back the transcript.
     - For real-time/streaming voice, use the WebSocket endpoint instead.
     """
-    request_id = getattr(request.state, 'request_id', 'unknown')
-    logger.info(f"[request_id={request_id}] /stream-speech-to-text called (method={request.method}) headers={dict(request.headers)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"/stream-speech-to-text called (method={request.method}) headers={dict(request.headers)}")
     stt_url = "http://stt_service:8003/stream-speech-to-text"
     start = time.time()
-    INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY", "changeme-internal-key")
-    async with httpx.AsyncClient(timeout=None) as client:
-        try:
-            async def proxy():
-                headers = {"x-internal-api-key": INTERNAL_API_KEY}
-                async with client.stream("POST", stt_url, content=request.stream(), headers=headers) as resp:
-                    async for chunk in resp.aiter_bytes():
-                        yield chunk
-            response = StreamingResponse(proxy(), media_type="text/plain")
-            # Add CORS headers explicitly for streaming POST
-            response.headers["Access-Control-Allow-Origin"] = "*"
-            response.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS"
-            response.headers["Access-Control-Allow-Headers"] = "Content-Type"
-            latency = (time.time() - start) * 1000
-            logger.info(f"[request_id={request_id}] /stream-speech-to-text setup complete | Latency: {latency:.2f}ms")
-            return response
-        except Exception as e:
-            logger.error(f"[request_id={request_id}] /stream-speech-to-text error: {e}")
-            raise HTTPException(status_code=500, detail=str(e))
+    try:
+        headers = {"x-internal-api-key": INTERNAL_API_KEY, **trace_headers(request)}
+        async def proxy():
+            async with http_client.stream("POST", stt_url, content=request.stream(), headers=headers) as resp:
+                async for chunk in resp.aiter_bytes():
+                    yield chunk
+        response = StreamingResponse(proxy(), media_type="text/plain")
+        # Add CORS headers explicitly for streaming POST
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        response.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS"
+        response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+        latency = (time.time() - start) * 1000
+        logger.debug("/stream-speech-to-text setup complete | Latency: %.2fms", latency)
+        return response
+    except Exception as e:
+        logger.error(f"/stream-speech-to-text error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/stream-text-to-speech")
 async def stream_text_to_speech(request: Request):
-    request_id = getattr(request.state, 'request_id', 'unknown')
-    logger.info(f"[request_id={request_id}] /stream-text-to-speech called")
+    logger.debug("/stream-text-to-speech called")
     tts_url = "http://tts_service:8004/stream-text-to-speech"
     start = time.time()
-    async with httpx.AsyncClient(timeout=None) as client:
-        try:
-            async def proxy():
-                async with client.stream("POST", tts_url, content=await request.body()) as resp:
-                    async for chunk in resp.aiter_bytes():
-                        yield chunk
-            response = StreamingResponse(proxy(), media_type="text/plain")
-            latency = (time.time() - start) * 1000
-            logger.info(f"[request_id={request_id}] /stream-text-to-speech setup complete | Latency: {latency:.2f}ms")
-            return response
-        except Exception as e:
-            logger.error(f"[request_id={request_id}] /stream-text-to-speech error: {e}")
-            raise HTTPException(status_code=500, detail=str(e))
+    try:
+        headers = {"x-internal-api-key": INTERNAL_API_KEY, "content-type": request.headers.get("content-type", "application/json"), **trace_headers(request)}
+        async def proxy():
+            # Forward the body as it arrives (like the STT proxy) instead of buffering it first
+            async with http_client.stream("POST", tts_url, content=request.stream(), headers=headers) as resp:
+                async for chunk in resp.aiter_bytes():
+                    yield chunk
+        response = StreamingResponse(proxy(), media_type="audio/mpeg")
+        latency = (time.time() - start) * 1000
+        logger.debug("/stream-text-to-speech setup complete | Latency: %.2fms", latency)
+        return response
+    except Exception as e:
+        logger.error(f"/stream-text-to-speech error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 @app.websocket("/ws/health")
 async def ws_health(websocket: WebSocket):
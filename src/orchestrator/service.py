@@ -3,9 +3,13 @@
 import httpx
 import asyncio
 import logging
-import json
+import orjson
 import os
 import secrets
+import random
+import hashlib
+from collections import OrderedDict
+from backpressure import AdaptiveLimiter, CircuitBreaker
 from fastapi import APIRouter
 import jwt
 import time
@@ -30,14 +34,106 @@ LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET", "your_livekit_api_secret")
 LIVEKIT_URL = os.getenv("LIVEKIT_URL", "http://livekit:7880")
 
 INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY", "changeme-internal-key")
+# Shared by every downstream JSON call; copy before adding per-request headers
+INTERNAL_API_HEADERS = {"x-internal-api-key": INTERNAL_API_KEY, "content-type": "application/json"}
+
+# Per-call budget for downstream POSTs: fail fast on connect, give the model/TTS time to answer
+DOWNSTREAM_READ_TIMEOUT = float(os.getenv("DOWNSTREAM_READ_TIMEOUT", "10.0"))
+DOWNSTREAM_TIMEOUT = httpx.Timeout(DOWNSTREAM_READ_TIMEOUT, connect=float(os.getenv("DOWNSTREAM_CONNECT_TIMEOUT", "0.25")))
+# Errors where the request never reached the service, so a retry cannot double the work
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout, httpx.RemoteProtocolError)
+# Attempts per backend; STT/TTS sit on the user's time-to-first-audio, so they get fewer
+SERVICE_RETRIES = {"llm1": 2, "llm2": 2, "stt": 1, "tts": 1}
+# Full-jitter backoff: retry n sleeps uniformly in [0, RETRY_BACKOFF_BASE * 2**n)
+RETRY_BACKOFF_BASE = 0.1
+# A Retry-After longer than this is not worth waiting for; use the fallback instead
+RETRY_AFTER_MAX = 2.0
+
+# Deployment LLM2 is asked to use; read once instead of per interaction
+LLM2_MODEL = os.getenv("AZURE_GPT4O_MINI_DEPLOYMENT", "gpt-4o-mini")
+
+# Only the most recent history messages are forwarded to LLM1/LLM2. Older ones are dropped in blocks
+# of HISTORY_TRIM_BLOCK, so the forwarded history starts at the same message for several turns
+# and LLM2's prompt prefix stays stable between block boundaries.
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "16"))
+HISTORY_TRIM_BLOCK = max(1, HISTORY_MAX_MESSAGES // 2)
+
+def recent_history(history: list) -> list:
+    drop = len(history) - HISTORY_MAX_MESSAGES
+    if drop <= 0:
+        return history
+    return history[-(-drop // HISTORY_TRIM_BLOCK) * HISTORY_TRIM_BLOCK:]
 
 router = APIRouter()
 
-# Circuit breaker state
-circuit_breakers = {"llm1": {"failures": 0, "open_until": 0}, "llm2": {"failures": 0, "open_until": 0}, "stt": {"failures": 0, "open_until": 0}, "tts": {"failures": 0, "open_until": 0}}
+# Pool sizes are per worker process; divide the downstream budget by WEB_CONCURRENCY when scaling out
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "200"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "100"))
+
+# Process-wide pooled client for calls to the downstream services; closed on app shutdown.
+# Downstream uvicorns keep idle connections for 75s, so expiring ours at 60s never reuses a socket
+# the server has already dropped. (Plain-http hops stay on HTTP/1.1: httpx only negotiates h2 over TLS.)
+http_client = httpx.AsyncClient(
+    # Finite default so a stalled stream (LLM2 tokens, TTS audio) errors out instead of hanging a session;
+    # for streams this bounds the wait between chunks, not the whole response
+    timeout=httpx.Timeout(DOWNSTREAM_READ_TIMEOUT, connect=1.0),
+    limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE, keepalive_expiry=60),
+)
+
+# Bodies safe_post hands back when a call fails; built once and only ever read
+FALLBACK_REPLY = "Sorry, something went wrong."
+LLM1_FALLBACK = {"context": "fallback-context", "rules": {}}
+LLM2_FALLBACK = {"response": FALLBACK_REPLY}
+STT_FALLBACK = {"transcript": ""}
+TTS_FALLBACK = {"audio_data": None}
+
+class DummyResp:
+    # Stands in for an httpx.Response when safe_post gives up; .json() returns the fallback body
+    def __init__(self, data, status_code, text, error_details):
+        self._data = data
+        self.status_code = status_code
+        self.text = text
+        self.error_details = error_details
 
-# Add in-memory cache for LLM1 context per session
-llm1_context_cache = {}
+    def json(self):
+        return self._data
+
+# Per-backend circuit breaker and adaptive (AIMD) in-flight limit
+BACKENDS = ("llm1", "llm2", "stt", "tts")
+circuit_breakers = {name: CircuitBreaker(failure_threshold=3, reset_timeout=30.0) for name in BACKENDS}
+limiters = {name: AdaptiveLimiter(initial=32, minimum=4, maximum=256) for name in BACKENDS}
+SERVICE_URLS = {"llm1": LLM1_URL, "llm2": LLM2_URL, "stt": STT_URL, "tts": TTS_URL}
+
+# LLM1 context per session/character: LRU-bounded, entries expire after LLM1_CACHE_TTL seconds
+LLM1_CACHE_SIZE = int(os.getenv("LLM1_CACHE_SIZE", "10000"))
+LLM1_CACHE_TTL = float(os.getenv("LLM1_CACHE_TTL", "600"))
+llm1_context_cache = OrderedDict()
+llm1_cache_stats = {"hits": 0, "misses": 0}
+# In-flight LLM1 calls keyed like the cache, so a cold character is generated once
+_llm1_inflight = {}
+
+def llm1_cache_key(session_id, character_details):
+    if session_id:
+        return session_id
+    # Fixed-size digest instead of keeping the whole serialized character around as the key
+    return hashlib.blake2b(orjson.dumps(character_details, option=orjson.OPT_SORT_KEYS), digest_size=16).hexdigest()
+
+def llm1_cache_get(key):
+    entry = llm1_context_cache.get(key)
+    if entry is None or entry[0] < time.monotonic():
+        if entry is not None:
+            del llm1_context_cache[key]
+        llm1_cache_stats["misses"] += 1
+        return None
+    llm1_context_cache.move_to_end(key)
+    llm1_cache_stats["hits"] += 1
+    return entry[1], entry[2]
+
+def llm1_cache_put(key, context, rules):
+    llm1_context_cache[key] = (time.monotonic() + LLM1_CACHE_TTL, context, rules)
+    llm1_context_cache.move_to_end(key)
+    if len(llm1_context_cache) > LLM1_CACHE_SIZE:
+        llm1_context_cache.popitem(last=False)
 
 @router.post("/voice-call/start")
 async def start_voice_call(user_id: str):
@@ -59,16 +155,24 @@ async def join_voice_call(user_id: str, room_name: str):
     return {"room": room_name, "token": token, "livekit_url": LIVEKIT_URL}
 
 # --- Token generation helper ---
+LIVEKIT_TOKEN_TTL = 3600  # 1 hour expiry
+# Reuse a signed token for repeated join/start calls while it still has most of its validity left
+LIVEKIT_TOKEN_REUSE = 600
+LIVEKIT_TOKEN_CACHE_SIZE = 10000
+_livekit_tokens = OrderedDict()
+
 def generate_livekit_token(user_id, room_name):
-    # Generate a JWT for LiveKit using pyjwt
-    api_key = LIVEKIT_API_KEY
-    api_secret = LIVEKIT_API_SECRET
     now = int(time.time())
+    key = (user_id, room_name)
+    cached = _livekit_tokens.get(key)
+    if cached is not None and now - cached[0] < LIVEKIT_TOKEN_REUSE:
+        return cached[1]
+    # Generate a JWT for LiveKit using pyjwt
     payload = {
-        "iss": api_key,
+        "iss": LIVEKIT_API_KEY,
         "sub": user_id,
         "nbf": now,
-        "exp": now + 3600,  # 1 hour expiry
+        "exp": now + LIVEKIT_TOKEN_TTL,
         "room": room_name,
         "video": True,
         "audio": True,
@@ -78,162 +182,259 @@ def generate_livekit_token(user_id, room_name):
         "can_publish_sources": ["audio"],
         "can_subscribe_sources": ["audio"],
     }
-    token = jwt.encode(payload, api_secret, algorithm="HS256")
+    token = jwt.encode(payload, LIVEKIT_API_SECRET, algorithm="HS256")
+    _livekit_tokens[key] = (now, token)
+    _livekit_tokens.move_to_end(key)
+    if len(_livekit_tokens) > LIVEKIT_TOKEN_CACHE_SIZE:
+        _livekit_tokens.popitem(last=False)
     return token
 
 # Log all URLs at startup
 logger.info(f"[ORCHESTRATOR] Service URLs: LLM1={LLM1_URL}, LLM2={LLM2_URL}, STT={STT_URL}, TTS={TTS_URL}")
 
-async def safe_post(client, url, json, fallback=None, retries=2, request_id=None, step_name=None):
-    service_name = None
-    if "llm1" in url: service_name = "llm1"
-    elif "llm2" in url: service_name = "llm2"
-    elif "stt" in url: service_name = "stt"
-    elif "tts" in url: service_name = "tts"
-    now = time.time()
-    if service_name and circuit_breakers[service_name]["open_until"] > now:
-        logger.error(f"[request_id={request_id}] [CB] Circuit open for {service_name}, skipping call.")
-        return type('DummyResp', (), {"json": lambda self: fallback or {}, "status_code": 503, "text": str(fallback), "error_details": {"status": 503, "message": "Circuit open"}})()
+def parse_retry_after(value):
+    # Only the delta-seconds form; HTTP-date values are treated as absent
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+async def safe_post(client, service_name, json, fallback=None, retries=None, request_id=None, step_name=None, timeout=DOWNSTREAM_TIMEOUT):
+    # service_name is one of BACKENDS; it picks the URL, breaker, limiter and retry budget
+    url = SERVICE_URLS[service_name]
+    breaker = circuit_breakers[service_name]
+    limiter = limiters[service_name]
+    if retries is None:
+        retries = SERVICE_RETRIES[service_name]
+    # Fallback responses hand back the same dict on every .json() call
+    fallback_data = fallback or {}
+    if not breaker.allow():
+        logger.error(f"[CB] Circuit open for {service_name}, skipping call.")
+        return DummyResp(fallback_data, 503, str(fallback), {"status": 503, "message": "Circuit open"})
+    # Downstream services log under the same correlation id as the orchestrator
+    headers = {**INTERNAL_API_HEADERS, "x-request-id": request_id} if request_id else INTERNAL_API_HEADERS
+    # Serialize once; retries resend the same bytes
+    body = orjson.dumps(json)
     start = time.time()
-    logger.info(f"[request_id={request_id}] [latency] Starting {step_name or url}")
     last_error = None
     for attempt in range(retries):
+        # 5xx, timeouts and connect failures shrink the backend's concurrency limit
+        overloaded = False
+        retry_after = None
+        await limiter.acquire()
         try:
-            resp = await client.post(url, json=json, timeout=10.0, headers={"x-internal-api-key": INTERNAL_API_KEY})
-            latency = (time.time() - start) * 1000
-            logger.info(f"[request_id={request_id}] [latency] {step_name or url} attempt {attempt+1}: {latency:.2f}ms, status={resp.status_code}")
+            resp = await client.post(url, content=body, timeout=timeout, headers=headers)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("downstream_call step=%s attempt=%d status=%d latency_ms=%.2f", step_name or service_name, attempt + 1, resp.status_code, (time.time() - start) * 1000)
+            overloaded = resp.status_code >= 500
             if resp.status_code == 200:
-                if service_name:
-                    circuit_breakers[service_name]["failures"] = 0
+                breaker.record_success()
                 return resp
-            logger.error(f"[request_id={request_id}] Non-200 response from {url}: {resp.status_code}, {resp.text}")
+            logger.error(f"Non-200 response from {url}: {resp.status_code}, {resp.text}")
             last_error = {"status": resp.status_code, "body": resp.text}
+            retryable = overloaded or resp.status_code == 429
+            if resp.status_code in (429, 503):
+                retry_after = parse_retry_after(resp.headers.get("retry-after"))
+                if retry_after is not None and retry_after > RETRY_AFTER_MAX:
+                    retryable = False
+        except RETRYABLE_ERRORS as e:
+            logger.error(f"Connection error calling {url}: {str(e)}")
+            last_error = {"status": "exception", "message": str(e)}
+            retryable = overloaded = True
         except Exception as e:
-            logger.error(f"[request_id={request_id}] Exception calling {url}: {str(e)}")
+            # Read timeouts and the like: the service may still be working on it, don't pile on
+            logger.error(f"Exception calling {url}: {str(e)}")
             last_error = {"status": "exception", "message": str(e)}
-        if service_name:
-            circuit_breakers[service_name]["failures"] += 1
-            if circuit_breakers[service_name]["failures"] >= 3:
-                circuit_breakers[service_name]["open_until"] = time.time() + 30
-                logger.error(f"[request_id={request_id}] [CB] Circuit opened for {service_name} for 30s due to repeated failures.")
-                break
+            retryable, overloaded = False, True
+        finally:
+            limiter.release(overloaded)
+        breaker.record_failure()
+        if breaker.is_open:
+            logger.error(f"[CB] Circuit opened for {service_name} for {breaker.reset_timeout:.0f}s due to repeated failures.")
+            break
+        if not retryable:
+            break
         if attempt < retries - 1:
-            wait_time = 0.5 * (2 ** attempt)
-            logger.info(f"[request_id={request_id}] Retrying in {wait_time}s (attempt {attempt+1}/{retries})")
+            # Full-jitter exponential backoff so callers don't retry in lockstep
+            wait_time = random.uniform(0, RETRY_BACKOFF_BASE * 2 ** attempt)
+            if retry_after is not None:
+                wait_time = max(wait_time, retry_after)
+            logger.debug("Retrying %s in %.3fs (attempt %d/%d)", step_name or service_name, wait_time, attempt + 1, retries)
             await asyncio.sleep(wait_time)
     latency = (time.time() - start) * 1000
-    logger.error(f"[request_id={request_id}] [latency] All retries failed for {step_name or url} after {latency:.2f}ms, using fallback")
-    class DummyResp:
-        def json(self_inner):
-            return fallback or {}
-        status_code = 500
-        text = str(fallback)
-        error_details = last_error
-    return DummyResp()
-
-async def orchestrate_interaction(user_input: str, character_details: dict, mode: str, audio_data: str = None, session_id: str = None, history: list = None, request_id: str = None):
+    logger.error(f"[latency] All retries failed for {step_name or service_name} after {latency:.2f}ms, using fallback")
+    return DummyResp(fallback_data, 500, str(fallback), last_error)
+
+def response_json(resp):
+    # orjson decodes the raw body directly; safe_post's fallback objects already hold a dict
+    if isinstance(resp, httpx.Response):
+        return orjson.loads(resp.content)
+    return resp.json()
+
+async def stream_tts(client, text: str, voice_type: str, on_chunk, url: str = TTS_STREAM_URL, request_id: str = None, output_format: str = None):
+    """
+    Stream synthesized audio for `text`, awaiting on_chunk(bytes) for each chunk as it arrives so
+    callers can play the first audio before synthesis finishes. Returns the TTS HTTP status.
+    output_format (e.g. "pcm_16000") asks for raw PCM instead of MP3.
+    """
+    headers = {**INTERNAL_API_HEADERS, "x-request-id": request_id} if request_id else INTERNAL_API_HEADERS
+    payload = {"text": text, "voice_type": voice_type}
+    if output_format:
+        payload["output_format"] = output_format
+    body = orjson.dumps(payload)
+    async with client.stream("POST", url, content=body, headers=headers) as resp:
+        if resp.status_code != 200:
+            error_body = await resp.aread()
+            logger.error(f"TTS stream error: {resp.status_code} {error_body.decode(errors='ignore')}")
+            return resp.status_code
+        async for chunk in resp.aiter_bytes():
+            if chunk:
+                await on_chunk(chunk)
+    return resp.status_code
+
+async def get_llm1_context(client, user_input: str, character_details: dict, session_id: str = None, history: list = None, request_id: str = None):
+    """
+    Return (context, rules, error) for a character, generating it with LLM1 at most once per
+    session/character. Keeping the persona context fixed keeps the LLM2 prompt prefix stable,
+    which is what lets provider-side prompt caching hit on later turns.
+    """
+    # Use session_id as cache key if available
+    cache_key = llm1_cache_key(session_id, character_details)
+    cached = llm1_cache_get(cache_key)
+    if cached is not None:
+        logger.debug("llm1_cache_hit session_id=%s", session_id)
+        return cached[0], cached[1], None
+    # Concurrent misses for the same key wait on the one LLM1 call already in flight
+    task = _llm1_inflight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(fetch_llm1_context(client, cache_key, user_input, character_details, session_id, history, request_id))
+        _llm1_inflight[cache_key] = task
+        task.add_done_callback(lambda _t: _llm1_inflight.pop(cache_key, None))
+    else:
+        logger.debug("llm1_coalesced session_id=%s", session_id)
+    # Shield so one cancelled caller does not cancel the call for the others
+    return await asyncio.shield(task)
+
+async def fetch_llm1_context(client, cache_key: str, user_input: str, character_details: dict, session_id: str = None, history: list = None, request_id: str = None):
+    # Static per-character fields first, per-turn fields last (same layout LLM2 uses for its prompt)
+    llm1_payload = {"character_details": character_details}
+    if session_id:
+        llm1_payload["session_id"] = session_id
+    if history:
+        llm1_payload["history"] = history
+    llm1_payload["user_input"] = user_input
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("llm1_call url=%s len_input=%d history=%d", LLM1_URL, len(user_input), len(history or ()))
+    llm1_start = time.time()
+    llm1_resp = await safe_post(client, "llm1", llm1_payload, fallback=LLM1_FALLBACK, request_id=request_id, step_name="LLM1")
+    llm1_latency = (time.time() - llm1_start) * 1000
+    llm1_data = response_json(llm1_resp)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("llm1_done latency_ms=%.2f", llm1_latency)
+    context = llm1_data.get("context", "fallback-context")
+    rules = llm1_data.get("rules", {})
+    if getattr(llm1_resp, 'status_code', 200) != 200 or context == "fallback-context":
+        llm1_error = getattr(llm1_resp, 'error_details', None) or llm1_data.get("error") or "LLM1 failed to generate context."
+        logger.error(f"[latency] LLM1 failed. Error: {llm1_error}, Response: {llm1_data}")
+        return context, rules, llm1_error
+    # Cache the context and rules for this session
+    llm1_cache_put(cache_key, context, rules)
+    return context, rules, None
+
+async def orchestrate_interaction(user_input: str, character_details: dict, mode: str, audio_data: str = None, session_id: str = None, history: list = None, request_id: str = None, client: httpx.AsyncClient = http_client):
     pipeline_start = time.time()
-    async with httpx.AsyncClient() as client:
-        if mode == "chat":
-            if not user_input or not character_details:
-                return {"response": "Missing user input or character details.", "audio_data": None, "error": {"orchestrator": "Missing required fields."}}
-            # Use session_id as cache key if available
-            cache_key = session_id or json.dumps(character_details, sort_keys=True)
-            if cache_key in llm1_context_cache:
-                context, rules = llm1_context_cache[cache_key]
-                logging.info(f"[request_id={request_id}] [latency] Using cached LLM1 context for session: {cache_key}")
-            else:
-                llm1_payload = {"user_input": user_input, "character_details": character_details}
-                if session_id:
-                    llm1_payload["session_id"] = session_id
-                if history:
-                    llm1_payload["history"] = history
-                logging.info(f"[request_id={request_id}] [latency] LLM1 payload: {json.dumps(llm1_payload)}")
-                llm1_start = time.time()
-                llm1_resp = await safe_post(client, LLM1_URL, llm1_payload, fallback={"context": "fallback-context", "rules": {}}, request_id=request_id, step_name="LLM1")
-                llm1_latency = (time.time() - llm1_start) * 1000
-                logging.info(f"[request_id={request_id}] [latency] LLM1 total: {llm1_latency:.2f}ms")
-                context = llm1_resp.json().get("context", "fallback-context")
-                rules = llm1_resp.json().get("rules", {})
-                llm1_error = None
-                if getattr(llm1_resp, 'status_code', 200) != 200 or context == "fallback-context":
-                    llm1_error = getattr(llm1_resp, 'error_details', None) or llm1_resp.json().get("error") or "LLM1 failed to generate context."
-                    logging.error(f"[request_id={request_id}] [latency] LLM1 failed. Error: {llm1_error}, Response: {llm1_resp.json()}")
-                    return {"response": "Sorry, the character could not generate context. Please try again later.", "audio_data": None, "error": {"llm1": llm1_error}}
-                # Cache the context and rules for this session
-                llm1_context_cache[cache_key] = (context, rules)
-            model = os.getenv("AZURE_GPT4O_MINI_DEPLOYMENT", "gpt-4o-mini")
-            llm2_payload = {"user_query": user_input, "persona_context": context, "rules": rules, "model": model}
-            if session_id:
-                llm2_payload["session_id"] = session_id
-            if history:
-                llm2_payload["history"] = history
-            logging.info(f"[request_id={request_id}] [latency] LLM2 payload: {json.dumps(llm2_payload)}")
-            llm2_start = time.time()
-            llm2_resp = await safe_post(client, LLM2_URL, llm2_payload, fallback={"response": "Sorry, something went wrong."}, request_id=request_id, step_name="LLM2")
-            llm2_latency = (time.time() - llm2_start) * 1000
-            logging.info(f"[request_id={request_id}] [latency] LLM2 total: {llm2_latency:.2f}ms")
-            response = llm2_resp.json().get("response", "Sorry, something went wrong.")
-            llm2_error = None
-            if getattr(llm2_resp, 'status_code', 200) != 200 or not response or not response.strip() or response == "Sorry, something went wrong.":
-                llm2_error = getattr(llm2_resp, 'error_details', None) or llm2_resp.json().get("error") or "LLM2 failed to generate response."
-                logging.error(f"[request_id={request_id}] [latency] LLM2 failed. Error: {llm2_error}, Response: {llm2_resp.json()}")
-                return {"response": "Sorry, the character could not respond. Please try again later.", "audio_data": None, "error": {"llm2": llm2_error}}
-            result = {"response": response, "audio_data": None, "error": None}
-            pipeline_latency = (time.time() - pipeline_start) * 1000
-            logging.info(f"[request_id={request_id}] [latency] Final orchestrator result: {result} | Pipeline total: {pipeline_latency:.2f}ms")
-            return result
-        elif mode == "voice":
-            stt_start = time.time()
-            logger.info(f"[request_id={request_id}] [latency] Calling STT: {STT_URL} with audio_data present: {audio_data is not None}")
-            stt_resp = await safe_post(client, STT_URL, {"audio_data": audio_data}, fallback={"transcript": ""}, request_id=request_id, step_name="STT")
-            stt_latency = (time.time() - stt_start) * 1000
-            transcript = stt_resp.json().get("transcript", "")
-            stt_error = None
-            if getattr(stt_resp, 'status_code', 200) != 200 or not transcript:
-                stt_error = getattr(stt_resp, 'error_details', None) or stt_resp.json().get("error") or "STT failed to transcribe audio."
-                logger.error(f"[request_id={request_id}] [latency] STT failed. Error: {stt_error}, Response: {stt_resp.json()}")
-                return {"response": "Sorry, we could not transcribe your audio. Please try again.", "audio_data": None, "error": {"stt": stt_error}}
-            logger.info(f"[request_id={request_id}] [latency] STT response: {stt_resp.json()} | STT total: {stt_latency:.2f}ms")
-            llm1_start = time.time()
-            llm1_resp = await safe_post(client, LLM1_URL, {"user_input": transcript, "character_details": character_details}, fallback={"context": "fallback-context", "rules": {}}, request_id=request_id, step_name="LLM1")
-            llm1_latency = (time.time() - llm1_start) * 1000
-            logger.info(f"[request_id={request_id}] [latency] LLM1 response: {llm1_resp.json()} | LLM1 total: {llm1_latency:.2f}ms")
-            context = llm1_resp.json().get("context", "fallback-context")
-            rules = llm1_resp.json().get("rules", {})
-            llm1_error = None
-            if getattr(llm1_resp, 'status_code', 200) != 200 or context == "fallback-context":
-                llm1_error = getattr(llm1_resp, 'error_details', None) or llm1_resp.json().get("error") or "LLM1 failed to generate context."
-                logger.error(f"[request_id={request_id}] [latency] LLM1 failed. Error: {llm1_error}, Response: {llm1_resp.json()}")
-                return {"response": "Sorry, the character could not generate context. Please try again later.", "audio_data": None, "error": {"llm1": llm1_error}}
-            model = os.getenv("AZURE_GPT4O_MINI_DEPLOYMENT", "gpt-4o-mini")
-            llm2_start = time.time()
-            logger.info(f"[request_id={request_id}] [latency] Calling LLM2: {LLM2_URL} with user_query: {transcript}, persona_context: {context}, rules: {rules}, model: {model}")
-            llm2_resp = await safe_post(client, LLM2_URL, {"user_query": transcript, "persona_context": context, "rules": rules, "model": model}, fallback={"response": "Sorry, something went wrong."}, request_id=request_id, step_name="LLM2")
-            llm2_latency = (time.time() - llm2_start) * 1000
-            logger.info(f"[request_id={request_id}] [latency] LLM2 response: {llm2_resp.json()} | LLM2 total: {llm2_latency:.2f}ms")
-            response = llm2_resp.json().get("response", "Sorry, something went wrong.")
-            llm2_error = None
-            if getattr(llm2_resp, 'status_code', 200) != 200 or not response or not response.strip() or response == "Sorry, something went wrong.":
-                llm2_error = getattr(llm2_resp, 'error_details', None) or llm2_resp.json().get("error") or "LLM2 failed to generate response."
-                logger.error(f"[request_id={request_id}] [latency] LLM2 failed. Error: {llm2_error}, Response: {llm2_resp.json()}")
-                return {"response": "Sorry, the character could not respond. Please try again later.", "audio_data": None, "error": {"llm2": llm2_error}}
-            tts_voice_type = character_details.get("voice_type", "predefined")
-            tts_start = time.time()
-            logger.info(f"[request_id={request_id}] [latency] Calling TTS: {TTS_URL} with text: {response}, voice_type: {tts_voice_type}")
-            tts_resp = await safe_post(client, TTS_URL, {"text": response, "voice_type": tts_voice_type}, fallback={"audio_data": None}, request_id=request_id, step_name="TTS")
-            tts_latency = (time.time() - tts_start) * 1000
-            logger.info(f"[request_id={request_id}] [latency] TTS response: {tts_resp.json()} | TTS total: {tts_latency:.2f}ms")
-            audio_out = tts_resp.json().get("audio_data", None)
-            tts_error = None
-            if getattr(tts_resp, 'status_code', 200) != 200 or not audio_out:
-                tts_error = getattr(tts_resp, 'error_details', None) or tts_resp.json().get("error") or "TTS failed to generate audio."
-                logger.error(f"[request_id={request_id}] [latency] TTS failed. Error: {tts_error}, Response: {tts_resp.json()}")
-                return {"response": response, "audio_data": None, "error": {"tts": tts_error}}
-            result = {"response": response, "audio_data": audio_out, "error": None}
-            pipeline_latency = (time.time() - pipeline_start) * 1000
-            logger.info(f"[request_id={request_id}] [latency] Final orchestrator result: {result} | Pipeline total: {pipeline_latency:.2f}ms")
-            return result
-        else:
-            logger.info(f"[request_id={request_id}] Invalid mode: {mode}")
-            return {"response": "Invalid mode", "audio_data": None, "error": {"orchestrator": "Invalid mode"}} 
\ No newline at end of file
+    if history:
+        history = recent_history(history)
+    if mode == "chat":
+        if not user_input or not character_details:
+            return {"response": "Missing user input or character details.", "audio_data": None, "error": {"orchestrator": "Missing required fields."}}
+        context, rules, llm1_error = await get_llm1_context(client, user_input, character_details, session_id=session_id, history=history, request_id=request_id)
+        if llm1_error:
+            return {"response": "Sorry, the character could not generate context. Please try again later.", "audio_data": None, "error": {"llm1": llm1_error}}
+        llm2_payload = {"persona_context": context, "rules": rules, "model": LLM2_MODEL}
+        if session_id:
+            llm2_payload["session_id"] = session_id
+        if history:
+            llm2_payload["history"] = history
+        llm2_payload["user_query"] = user_input
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("llm2_call url=%s len_input=%d history=%d", LLM2_URL, len(user_input), len(history or ()))
+        llm2_start = time.time()
+        llm2_resp = await safe_post(client, "llm2", llm2_payload, fallback=LLM2_FALLBACK, request_id=request_id, step_name="LLM2")
+        llm2_latency = (time.time() - llm2_start) * 1000
+        llm2_data = response_json(llm2_resp)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("llm2_done latency_ms=%.2f", llm2_latency)
+        response = llm2_data.get("response", FALLBACK_REPLY)
+        llm2_error = None
+        if getattr(llm2_resp, 'status_code', 200) != 200 or not response or not response.strip() or response == FALLBACK_REPLY:
+            llm2_error = getattr(llm2_resp, 'error_details', None) or llm2_data.get("error") or "LLM2 failed to generate response."
+            logger.error(f"[latency] LLM2 failed. Error: {llm2_error}, Response: {llm2_data}")
+            return {"response": "Sorry, the character could not respond. Please try again later.", "audio_data": None, "error": {"llm2": llm2_error}}
+        result = {"response": response, "audio_data": None, "error": None}
+        pipeline_latency = (time.time() - pipeline_start) * 1000
+        logger.info("chat interaction done | response chars=%d | Pipeline total: %.2fms", len(response), pipeline_latency)
+        return result
+    elif mode == "voice":
+        # LLM1 builds the persona context from character_details alone, so it runs while STT transcribes
+        llm1_task = asyncio.create_task(get_llm1_context(client, user_input, character_details, session_id=session_id, request_id=request_id))
+        stt_start = time.time()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("stt_call url=%s len_audio=%d", STT_URL, len(audio_data or ""))
+        stt_resp = await safe_post(client, "stt", {"audio_data": audio_data}, fallback=STT_FALLBACK, request_id=request_id, step_name="STT")
+        stt_latency = (time.time() - stt_start) * 1000
+        stt_data = response_json(stt_resp)
+        transcript = stt_data.get("transcript", "")
+        stt_error = None
+        if getattr(stt_resp, 'status_code', 200) != 200 or not transcript:
+            stt_error = getattr(stt_resp, 'error_details', None) or stt_data.get("error") or "STT failed to transcribe audio."
+            logger.error(f"[latency] STT failed. Error: {stt_error}, Response: {stt_data}")
+            # Don't leave the LLM1 wait running unawaited; a fetch already in flight still lands in the cache
+            llm1_task.cancel()
+            try:
+                await llm1_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            return {"response": "Sorry, we could not transcribe your audio. Please try again.", "audio_data": None, "error": {"stt": stt_error}}
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("stt_done latency_ms=%.2f len_transcript=%d", stt_latency, len(transcript))
+        # Reuse the session's LLM1 context so the LLM2 prompt prefix stays identical across turns
+        context, rules, llm1_error = await llm1_task
+        if llm1_error:
+            return {"response": "Sorry, the character could not generate context. Please try again later.", "audio_data": None, "error": {"llm1": llm1_error}}
+        llm2_start = time.time()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("llm2_call url=%s len_input=%d model=%s", LLM2_URL, len(transcript), LLM2_MODEL)
+        llm2_resp = await safe_post(client, "llm2", {"persona_context": context, "rules": rules, "model": LLM2_MODEL, "user_query": transcript}, fallback=LLM2_FALLBACK, request_id=request_id, step_name="LLM2")
+        llm2_latency = (time.time() - llm2_start) * 1000
+        llm2_data = response_json(llm2_resp)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("llm2_done latency_ms=%.2f", llm2_latency)
+        response = llm2_data.get("response", FALLBACK_REPLY)
+        llm2_error = None
+        if getattr(llm2_resp, 'status_code', 200) != 200 or not response or not response.strip() or response == FALLBACK_REPLY:
+            llm2_error = getattr(llm2_resp, 'error_details', None) or llm2_data.get("error") or "LLM2 failed to generate response."
+            logger.error(f"[latency] LLM2 failed. Error: {llm2_error}, Response: {llm2_data}")
+            return {"response": "Sorry, the character could not respond. Please try again later.", "audio_data": None, "error": {"llm2": llm2_error}}
+        tts_voice_type = character_details.get("voice_type", "predefined")
+        tts_start = time.time()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("tts_call url=%s len_text=%d voice_type=%s", TTS_URL, len(response), tts_voice_type)
+        tts_resp = await safe_post(client, "tts", {"text": response, "voice_type": tts_voice_type}, fallback=TTS_FALLBACK, request_id=request_id, step_name="TTS")
+        tts_latency = (time.time() - tts_start) * 1000
+        tts_data = response_json(tts_resp)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("tts_done latency_ms=%.2f", tts_latency)
+        audio_out = tts_data.get("audio_data", None)
+        tts_error = None
+        if getattr(tts_resp, 'status_code', 200) != 200 or not audio_out:
+            tts_error = getattr(tts_resp, 'error_details', None) or tts_data.get("error") or "TTS failed to generate audio."
+            logger.error(f"[latency] TTS failed. Error: {tts_error}, Response: {tts_data}")
+            return {"response": response, "audio_data": None, "error": {"tts": tts_error}}
+        result = {"response": response, "audio_data": audio_out, "error": None}
+        pipeline_latency = (time.time() - pipeline_start) * 1000
+        logger.info("voice interaction done | response chars=%d, audio chars=%d | Pipeline total: %.2fms", len(response), len(audio_out), pipeline_latency)
+        return result
+    else:
+        logger.info(f"Invalid mode: {mode}")
+        return {"response": "Invalid mode", "audio_data": None, "error": {"orchestrator": "Invalid mode"}} 
\ No newline at end of file
@@ -0,0 +1,46 @@
+import asyncio
+from backpressure import AdaptiveLimiter, CircuitBreaker
+
+def test_limiter_caps_concurrency():
+    async def run():
+        limiter = AdaptiveLimiter(initial=2, minimum=1, maximum=2)
+        active = peak = 0
+        async def call():
+            nonlocal active, peak
+            await limiter.acquire()
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            limiter.release()
+        await asyncio.gather(*(call() for _ in range(6)))
+        return peak
+    assert asyncio.run(run()) == 2
+
+def test_limiter_aimd():
+    limiter = AdaptiveLimiter(initial=8, minimum=2, maximum=9)
+    limiter.in_flight = 1
+    limiter.release(overloaded=True)
+    assert limiter.limit == 4
+    for _ in range(4):
+        limiter.in_flight = 1
+        limiter.release()
+    assert limiter.limit == 5
+
+def test_breaker_half_open_probe():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open
+    # Timeout elapsed: exactly one probe, whose failure re-opens the circuit
+    breaker.reset_timeout = 60.0
+    breaker.opened_at -= 60.0
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open
+    breaker.opened_at -= 60.0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.allow() and breaker.failures == 0
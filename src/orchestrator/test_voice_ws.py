@@ -0,0 +1,31 @@
+import asyncio
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("webrtcvad")
+import voice_ws
+
+def test_warmup_swallows_session_store_errors(monkeypatch):
+    async def fake_llm1(client, user_input, character_details, session_id=None):
+        return "context", {"style": "calm"}, None
+    async def broken_get_session(session_id):
+        raise ConnectionError("redis down")
+    monkeypatch.setattr(voice_ws, "get_llm1_context", fake_llm1)
+    monkeypatch.setattr(voice_ws, "get_session", broken_get_session)
+    # Turns await the warmup task and read its result, so a store error must come back as None
+    task_result = asyncio.run(voice_ws.warmup_llm1("s1", {"name": "Alice"}))
+    assert task_result is None
+
+def test_warmup_returns_context(monkeypatch):
+    stored = {}
+    async def fake_llm1(client, user_input, character_details, session_id=None):
+        return "context", {"style": "calm"}, None
+    async def get_session(session_id):
+        return {"id": session_id}
+    async def set_session(session_id, session):
+        stored[session_id] = session
+    monkeypatch.setattr(voice_ws, "get_llm1_context", fake_llm1)
+    monkeypatch.setattr(voice_ws, "get_session", get_session)
+    monkeypatch.setattr(voice_ws, "set_session", set_session)
+    assert asyncio.run(voice_ws.warmup_llm1("s1", {})) == ("context", {"style": "calm"})
+    assert stored["s1"]["llm1_context"] == "context"
@@ -1,18 +1,16 @@
-import json
+import orjson
+import msgspec
 import logging
 import uuid
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Request
 from starlette.websockets import WebSocketState
-import base64
-import httpx
 import os
+from typing import Optional
 import asyncio
 from utils.redis_session import get_session, set_session, delete_session
-from speech.vad import is_speech
+from service import http_client, stream_tts, get_llm1_context, DOWNSTREAM_TIMEOUT
+from speech.vad import StreamingVAD, SpeechGate
 import sys
-import numpy as np
-import time
-import threading
 import websockets
 
 router = APIRouter()
@@ -35,19 +33,71 @@ MSG_TYPE_ERROR = "error"
 # Service URLs (use orchestrator/service.py logic)
 STT_URL = os.getenv("STT_URL", "http://stt_service:8003/speech-to-text")
 LLM2_URL = os.getenv("LLM2_URL", "http://llm2_service:8002/generate-response")
+LLM2_STREAM_URL = os.getenv("LLM2_STREAM_URL", "http://llm2_service:8002/stream-response")
 TTS_STREAM_URL = os.getenv("TTS_STREAM_URL", "http://tts_service:8004/stream-text-to-speech")
 STT_STREAM_URL = os.getenv("STT_STREAM_URL", "http://stt_service:8003/stream-speech-to-text")
 INTERNAL_API_KEY = os.getenv("INTERNAL_API_KEY", "changeme-internal-key")
+INTERNAL_API_HEADERS = {"x-internal-api-key": INTERNAL_API_KEY, "content-type": "application/json"}
+# Format of the audio the TTS service streams back (ElevenLabs MP3)
+TTS_MIME = "audio/mpeg"
 
 VAD_STT_ONLY = os.getenv("VAD_STT_ONLY", "0") == "1"
 TTS_ONLY = os.getenv("TTS_ONLY", "0") == "1"
 LLM_ONLY = os.getenv("LLM_ONLY", "0") == "1"
+VAD_GATE = os.getenv("VAD_GATE", "1") == "1"
+# Deepgram closes a stream after ~10 s without audio; while the gate drops silence, send a KeepAlive this often
+STT_KEEPALIVE_S = 5
+STT_KEEPALIVE_MSG = '{"type": "KeepAlive"}'
+VAD_FRAME_MS = 20
+
+# Messages kept in the session history (user + assistant); older turns are dropped
+HISTORY_MAX_MESSAGES = int(os.getenv("HISTORY_MAX_MESSAGES", "16"))
+
+# Concurrent voice sessions per worker; extra connections are closed with 1013 (try again later)
+MAX_WS_SESSIONS = int(os.getenv("MAX_WS_SESSIONS", "500"))
+
+# How long a turn waits for the INIT-time LLM1 warmup before answering with the stub context
+LLM1_WARMUP_WAIT = float(os.getenv("LLM1_WARMUP_WAIT", "1.5"))
+WS_CLOSE_TRY_AGAIN_LATER = 1013
+_session_slots = asyncio.Semaphore(MAX_WS_SESSIONS)
 
 print("[STARTUP] voice_ws.py loaded", file=sys.stderr)
 
-# Add buffer dump state
-DUMP_LIMIT = 5
-received_buffers = {}
+# Typed messages decoded straight from the wire with msgspec (schema checked at the boundary)
+class InitMessage(msgspec.Struct):
+    type: str
+    characterDetails: dict
+
+class SttMessage(msgspec.Struct):
+    # Non-transcript STT events (and frames that don't fit this shape) are forwarded to the client as the raw frame
+    type: str = ""
+    text: Optional[str] = None
+
+init_decoder = msgspec.json.Decoder(InitMessage)
+stt_decoder = msgspec.json.Decoder(SttMessage)
+
+async def send_json(websocket: WebSocket, msg: dict):
+    # orjson encodes straight to UTF-8 bytes; send as a text frame to keep the protocol unchanged
+    await websocket.send_text(orjson.dumps(msg).decode())
+
+async def warmup_llm1(session_id: str, character_details: dict):
+    # Started at INIT so the LLM1 call overlaps the greeting instead of delaying the first reply.
+    # Returns (context, rules), or None on any failure (LLM1 or session store) so the stub context stays;
+    # turns await this task, so it must never raise.
+    try:
+        context, rules, error = await get_llm1_context(http_client, "", character_details, session_id=session_id)
+        if error:
+            raise RuntimeError(error)
+        session = await get_session(session_id)
+        if session is not None:
+            session["llm1_context"] = context
+            session["llm1_rules"] = rules
+            await set_session(session_id, session)
+    except Exception as e:
+        logger.warning("[WS %s] LLM1 warmup failed, keeping stub context: %s", session_id, e)
+        return None
+    logger.debug("[WS %s] LLM1 context ready", session_id)
+    return context, rules
 
 @router.on_event("startup")
 async def startup_event():
@@ -60,55 +110,62 @@ async def ws_voice_session_catchall(request: Request):
 
 @router.websocket("/ws/voice-session")
 async def voice_session_ws(websocket: WebSocket):
-    print("[WS] Connection attempt received", file=sys.stderr)
+    logger.debug("[WS] Connection attempt received")
     await websocket.accept()
+    if _session_slots.locked():
+        logger.warning("[WS] Session limit reached (%d), rejecting connection", MAX_WS_SESSIONS)
+        await websocket.close(code=WS_CLOSE_TRY_AGAIN_LATER)
+        return
+    # Free slot checked above, so this does not block; released in the finally below
+    await _session_slots.acquire()
     session_id = str(uuid.uuid4())
     logger.info(f"[WS] New voice session: {session_id}")
-    print(f"[WS] New voice session: {session_id}", file=sys.stderr)
+    llm1_warmup = None
     session_data = {
         "id": session_id,
         "state": {},
-        "buffer": bytearray(),
         "llm1_context": None,
+        "llm1_rules": {},
         "character_details": None,
         "history": [],
         "tts_playing": False,
     }
-    await set_session(session_id, {**session_data, "buffer": ""})
-    received_buffers[session_id] = 0
     try:
+        await set_session(session_id, session_data)
         # 1. Wait for INIT message with character details
-        print(f"[WS {session_id}] Waiting for INIT message", file=sys.stderr)
+        logger.debug("[WS %s] Waiting for INIT message", session_id)
         init_msg = await websocket.receive_text()
-        print(f"[WS {session_id}] Received INIT message: {init_msg}", file=sys.stderr)
+        logger.debug("[WS %s] Received INIT message: %s", session_id, init_msg)
         try:
-            init_data = json.loads(init_msg)
-            if init_data.get("type") != MSG_TYPE_INIT or "characterDetails" not in init_data:
+            init_data = init_decoder.decode(init_msg)
+            if init_data.type != MSG_TYPE_INIT:
                 raise ValueError("First message must be INIT with character_details")
-        except Exception as e:
+        except (msgspec.DecodeError, ValueError) as e:
             logger.error(f"[WS {session_id}] Invalid INIT: {e}")
-            print(f"[WS {session_id}] Invalid INIT: {e}", file=sys.stderr)
-            await websocket.send_json({"type": MSG_TYPE_ERROR, "error": f"Invalid INIT: {e}"})
+            await send_json(websocket, {"type": MSG_TYPE_ERROR, "error": f"Invalid INIT: {e}"})
             await websocket.close()
-            print(f"[WS {session_id}] Closed due to invalid INIT", file=sys.stderr)
+            logger.debug("[WS %s] Closed due to invalid INIT", session_id)
             return
         session = await get_session(session_id)
-        session["character_details"] = init_data["characterDetails"]
+        session["character_details"] = init_data.characterDetails
         await set_session(session_id, session)
-        logger.info(f"[WS {session_id}] Session initialized with character: {init_data['characterDetails']}")
-        print(f"[WS {session_id}] Session initialized with character: {init_data['characterDetails']}", file=sys.stderr)
-        # 2. Run LLM1 to generate system prompt/context (stub for now)
-        llm1_context = f"[SYSTEM_PROMPT for {init_data['characterDetails'].get('name', 'character')}]"
+        logger.info("[WS %s] Session initialized with character: %s", session_id, init_data.characterDetails.get("name"))
+        # 2. Stub context until LLM1 answers; the real one is fetched in the background
+        llm1_context = f"[SYSTEM_PROMPT for {init_data.characterDetails.get('name', 'character')}]"
         session["llm1_context"] = llm1_context
         await set_session(session_id, session)
+        llm1_warmup = asyncio.create_task(warmup_llm1(session_id, init_data.characterDetails))
         # 3. Send AI greeting (stub for now)
-        greeting_text = f"Hello, I am {init_data['characterDetails'].get('name', 'your assistant')}! How can I help you today?"
-        await websocket.send_json({"type": MSG_TYPE_GREETING, "text": greeting_text})
-        logger.info(f"[WS {session_id}] Sent greeting: {greeting_text}")
+        greeting_text = f"Hello, I am {init_data.characterDetails.get('name', 'your assistant')}! How can I help you today?"
+        await send_json(websocket, {"type": MSG_TYPE_GREETING, "text": greeting_text})
+        logger.debug("[WS %s] Sent greeting: %s", session_id, greeting_text)
         # --- NEW: Open persistent WebSocket to STT service ---
         stt_ws_url = "ws://stt_service:8003/ws/stream-speech-to-text"
         async with websockets.connect(stt_ws_url, max_size=2**24) as stt_ws:
             async def frontend_to_stt():
+                # Only speech (plus hangover) is forwarded; frames are cut to exact 20 ms VAD frames
+                gate = SpeechGate(StreamingVAD(frame_ms=VAD_FRAME_MS), keepalive_frames=STT_KEEPALIVE_S * 1000 // VAD_FRAME_MS) if VAD_GATE else None
+                speaking = False
                 while True:
                     msg = await websocket.receive()
                     if msg["type"] == "websocket.disconnect":
@@ -116,18 +173,36 @@ async def voice_session_ws(websocket: WebSocket):
                         break
                     if msg["type"] == "websocket.receive" and "bytes" in msg:
                         audio_chunk = msg["bytes"]
-                        await stt_ws.send(audio_chunk)
-                        # logger.info(f"[WS {session_id}] Forwarded {len(audio_chunk)} bytes to STT WS")
+                        if gate is None:
+                            await stt_ws.send(audio_chunk)
+                            continue
+                        audio, now_speaking = gate.feed(audio_chunk)
+                        if now_speaking != speaking:
+                            speaking = now_speaking
+                            await send_json(websocket, {"type": MSG_TYPE_VAD_STATE, "speaking": speaking})
+                        if audio:
+                            await stt_ws.send(audio)
+                        elif gate.take_keepalive():
+                            # Text frame: the STT service relays it to Deepgram as a control message
+                            await stt_ws.send(STT_KEEPALIVE_MSG)
             async def stt_to_frontend():
                 async for stt_msg in stt_ws:
                     try:
-                        data = json.loads(stt_msg)
-                        if data.get("type") == "transcript":
-                            transcript = data["text"]
-                            await websocket.send_json({"type": MSG_TYPE_TRANSCRIPT_FINAL, "text": transcript})
-                            logger.info(f"[WS {session_id}] Forwarded transcript to frontend: {transcript}")
+                        try:
+                            data = stt_decoder.decode(stt_msg)
+                        except msgspec.DecodeError:
+                            data = None
+                        if data is not None and data.type == "transcript":
+                            transcript = data.text or ""
+                            await send_json(websocket, {"type": MSG_TYPE_TRANSCRIPT_FINAL, "text": transcript})
+                            logger.debug("[WS %s] Forwarded transcript to frontend: %s", session_id, transcript)
 
                             # --- NEW: Call LLM2 for a response ---
+                            # Normally finished during the greeting; a slow LLM1 only holds the turn for LLM1_WARMUP_WAIT
+                            try:
+                                await asyncio.wait_for(asyncio.shield(llm1_warmup), LLM1_WARMUP_WAIT)
+                            except asyncio.TimeoutError:
+                                logger.info("[WS %s] LLM1 not ready after %.1fs, answering with stub context", session_id, LLM1_WARMUP_WAIT)
                             session = await get_session(session_id)
                             character_details = session.get("character_details", {})
                             history = session.get("history", [])
@@ -135,71 +210,82 @@ async def voice_session_ws(websocket: WebSocket):
                             llm2_payload = {
                                 "user_query": transcript,
                                 "persona_context": persona_context,
-                                "rules": {},  # TODO: fill with actual rules if available
+                                "rules": session.get("llm1_rules", {}),
                                 "model": "gpt-4o-mini"
                             }
+                            # Forward LLM2 tokens as they stream in; llm2_final carries the full text
+                            llm2_response = ""
                             try:
-                                async with httpx.AsyncClient() as client:
-                                    resp = await client.post(
-                                        LLM2_URL,
-                                        json=llm2_payload,
-                                        headers={"x-internal-api-key": INTERNAL_API_KEY}
-                                    )
-                                    llm2_response = resp.json().get("response", "")
+                                async with http_client.stream(
+                                    "POST",
+                                    LLM2_STREAM_URL,
+                                    content=orjson.dumps(llm2_payload),
+                                    headers=INTERNAL_API_HEADERS,
+                                    # Per-read bound: a stalled LLM2 ends the turn with the error reply instead of hanging it
+                                    timeout=DOWNSTREAM_TIMEOUT
+                                ) as resp:
+                                    resp.raise_for_status()
+                                    async for delta in resp.aiter_text():
+                                        if delta:
+                                            llm2_response += delta
+                                            await send_json(websocket, {"type": MSG_TYPE_LLM2_PARTIAL, "text": delta})
                             except Exception as e:
                                 logger.error(f"[WS {session_id}] Error calling LLM2: {e}")
-                                llm2_response = "[Error: LLM2 unavailable]"
+                                if not llm2_response:
+                                    llm2_response = "[Error: LLM2 unavailable]"
+                            # The warmup may have finished during this turn; keep its context instead of writing the stub back
+                            if llm1_warmup.done() and llm1_warmup.result():
+                                session["llm1_context"], session["llm1_rules"] = llm1_warmup.result()
                             # Update history
                             history.append({"role": "user", "content": transcript})
                             history.append({"role": "assistant", "content": llm2_response})
-                            session["history"] = history
+                            session["history"] = history[-HISTORY_MAX_MESSAGES:]
                             await set_session(session_id, session)
                             # Send LLM2 response to frontend
-                            await websocket.send_json({"type": MSG_TYPE_LLM2_FINAL, "text": llm2_response})
-                            logger.info(f"[WS {session_id}] Forwarded LLM2 response to frontend: {llm2_response}")
+                            await send_json(websocket, {"type": MSG_TYPE_LLM2_FINAL, "text": llm2_response})
+                            logger.debug("[WS %s] Forwarded LLM2 response to frontend: %s", session_id, llm2_response)
 
                             # --- NEW: Stream TTS audio to frontend ---
+                            tts_seq = 0
+                            async def send_tts_chunk(chunk):
+                                # Header text frame, then the raw audio as a binary frame (no base64)
+                                nonlocal tts_seq
+                                await send_json(websocket, {"type": MSG_TYPE_TTS_CHUNK, "seq": tts_seq, "mime": TTS_MIME, "bytes": len(chunk)})
+                                await websocket.send_bytes(chunk)
+                                tts_seq += 1
                             try:
-                                async with httpx.AsyncClient(timeout=None) as client:
-                                    tts_headers = {"x-internal-api-key": INTERNAL_API_KEY}
-                                    tts_payload = {"text": llm2_response}
-                                    tts_url = TTS_STREAM_URL
-                                    async with client.stream("POST", tts_url, headers=tts_headers, json=tts_payload) as tts_resp:
-                                        if tts_resp.status_code != 200:
-                                            error_body = await tts_resp.aread()
-                                            logger.error(f"[WS {session_id}] TTS error: {tts_resp.status_code} {error_body.decode(errors='ignore')}")
-                                            await websocket.send_json({"type": MSG_TYPE_ERROR, "error": f"TTS error: {tts_resp.status_code}"})
-                                        else:
-                                            async for chunk in tts_resp.aiter_bytes():
-                                                if chunk:
-                                                    await websocket.send_bytes(json.dumps({"type": MSG_TYPE_TTS_CHUNK, "audio": base64.b64encode(chunk).decode()} ).encode())
-                                            await websocket.send_json({"type": MSG_TYPE_TTS_END})
-                                            logger.info(f"[WS {session_id}] Streamed TTS audio to frontend.")
+                                voice_type = character_details.get("voice_type", "predefined")
+                                tts_status = await stream_tts(http_client, llm2_response, voice_type, send_tts_chunk, url=TTS_STREAM_URL)
+                                if tts_status != 200:
+                                    await send_json(websocket, {"type": MSG_TYPE_ERROR, "error": f"TTS error: {tts_status}"})
+                                else:
+                                    await send_json(websocket, {"type": MSG_TYPE_TTS_END})
+                                    logger.debug("[WS %s] Streamed TTS audio to frontend.", session_id)
                             except Exception as e:
                                 logger.error(f"[WS {session_id}] Error streaming TTS audio: {e}")
-                                await websocket.send_json({"type": MSG_TYPE_ERROR, "error": f"TTS streaming error: {e}"})
+                                await send_json(websocket, {"type": MSG_TYPE_ERROR, "error": f"TTS streaming error: {e}"})
                         else:
-                            await websocket.send_json(data)
+                            await websocket.send_text(stt_msg if isinstance(stt_msg, str) else stt_msg.decode())
                     except Exception as e:
                         logger.error(f"[WS {session_id}] Error parsing STT WS message: {e}")
             await asyncio.gather(frontend_to_stt(), stt_to_frontend())
     except WebSocketDisconnect:
         logger.info(f"[WS {session_id}] Session disconnected (WebSocketDisconnect)")
-        print(f"[WS {session_id}] Session disconnected (WebSocketDisconnect)", file=sys.stderr)
     except Exception as e:
         logger.error(f"[WS {session_id}] Error in session: {e}")
-        print(f"[WS {session_id}] Error in session: {e}", file=sys.stderr)
         try:
-            await websocket.send_json({"type": MSG_TYPE_ERROR, "error": str(e)})
+            await send_json(websocket, {"type": MSG_TYPE_ERROR, "error": str(e)})
         except Exception:
             pass
     finally:
-        logger.info(f"[WS {session_id}] Cleaning up session.")
-        print(f"[WS {session_id}] Cleaning up session.", file=sys.stderr)
+        logger.debug("[WS %s] Cleaning up session.", session_id)
+        if llm1_warmup is not None and not llm1_warmup.done():
+            llm1_warmup.cancel()
+        _session_slots.release()
         await delete_session(session_id)
         if websocket.application_state != WebSocketState.DISCONNECTED:
             try:
                 await websocket.close()
-                print(f"[WS {session_id}] WebSocket closed in finally block", file=sys.stderr)
+                logger.debug("[WS %s] WebSocket closed in finally block", session_id)
             except Exception:
                 pass 
\ No newline at end of file
@@ -0,0 +1,36 @@
+import pytest
+
+pytest.importorskip("webrtcvad")
+from speech.vad import SpeechGate
+
+class FakeVAD:
+    frame_bytes = 4
+
+    def is_speech(self, frame):
+        return frame[0] == 1
+
+def test_gate_reframes_and_applies_hangover():
+    gate = SpeechGate(FakeVAD(), hangover_frames=1)
+    # Split mid-frame: nothing complete yet
+    assert gate.feed(b"\x01\x01") == (b"", False)
+    out, speaking = gate.feed(b"\x01\x01" + b"\x00" * 8)
+    # speech frame + one hangover frame; the second silent frame is dropped
+    assert out == b"\x01" * 4 + b"\x00" * 4
+    assert speaking is False
+
+def test_gate_keeps_partial_frame_for_next_chunk():
+    gate = SpeechGate(FakeVAD(), hangover_frames=0)
+    assert gate.feed(b"\x01\x01\x01\x01\x01") == (b"\x01" * 4, False)
+    assert bytes(gate.buf) == b"\x01"
+
+def test_gate_requests_keepalive_during_long_silence():
+    # 20 ms frames: 5 s of dropped audio per keepalive, fed 11 s of silence
+    gate = SpeechGate(FakeVAD(), hangover_frames=0, keepalive_frames=250)
+    keepalives = 0
+    for _ in range(550):
+        assert gate.feed(b"\x00" * 4) == (b"", False)
+        keepalives += gate.take_keepalive()
+    assert keepalives == 2
+    # Speech resets the idle count
+    gate.feed(b"\x01" * 4)
+    assert gate.idle_frames == 0 and not gate.take_keepalive()
@@ -31,6 +31,48 @@ class StreamingVAD:
             buf = buf[self.frame_bytes:]
             yield self.is_speech(frame), frame
 
+class SpeechGate:
+    """
+    Re-frames an arbitrary PCM byte stream into exact VAD frames and passes through
+    speech frames plus a short hangover, so trailing phonemes and endpointing silence survive.
+    With keepalive_frames set, take_keepalive() reports each time that many frames in a row
+    were dropped, so the caller can keep an idle STT stream from timing out.
+    """
+    def __init__(self, vad: StreamingVAD, hangover_frames=15, keepalive_frames=0):
+        self.vad = vad
+        self.hangover_frames = hangover_frames
+        self.keepalive_frames = keepalive_frames
+        self.remaining = 0
+        self.idle_frames = 0
+        self.buf = bytearray()
+
+    def feed(self, chunk: bytes):
+        """Returns (bytes to forward, speaking) for the frames completed by this chunk."""
+        self.buf.extend(chunk)
+        out = bytearray()
+        n = self.vad.frame_bytes
+        while len(self.buf) >= n:
+            frame = bytes(self.buf[:n])
+            del self.buf[:n]
+            if self.vad.is_speech(frame):
+                self.remaining = self.hangover_frames
+                self.idle_frames = 0
+                out += frame
+            elif self.remaining:
+                self.remaining -= 1
+                self.idle_frames = 0
+                out += frame
+            else:
+                self.idle_frames += 1
+        return bytes(out), self.remaining > 0
+
+    def take_keepalive(self) -> bool:
+        """True once per keepalive_frames dropped frames; resets the idle count."""
+        if self.keepalive_frames and self.idle_frames >= self.keepalive_frames:
+            self.idle_frames = 0
+            return True
+        return False
+
 # Simple helper for one-off frame checks
 vad_instance = StreamingVAD()
 def is_speech(audio_chunk: bytes) -> bool:
@@ -3,6 +3,8 @@ import os
 import sys
 import time
 import uuid
+import re
+import traceback
 from fastapi import Request, Response, HTTPException, Header, Depends
 from pydantic import BaseModel
 from service import app  
@@ -39,9 +41,15 @@ async def verify_internal_api_key(x_internal_api_key: str = Header(...)):
         logger.error(f"[STT] Invalid or missing internal API key: {x_internal_api_key}")
         raise HTTPException(status_code=403, detail="Forbidden: invalid internal API key")
 
+# Accepted shape for an incoming x-request-id; anything else gets a fresh id
+REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    request_id = str(uuid.uuid4())
+    # Adopt the caller's id when it is well-formed, so logs line up with the orchestrator's
+    request_id = request.headers.get("x-request-id", "")
+    if not REQUEST_ID_RE.fullmatch(request_id):
+        request_id = str(uuid.uuid4())
     request.state.request_id = request_id
     logger.info(f"[request_id={request_id}] Request: {request.method} {request.url}")
     start = time.time()
@@ -51,6 +59,5 @@ async def log_requests(request: Request, call_next):
         logger.info(f"[request_id={request_id}] Response status: {response.status_code} | Latency: {latency:.2f}ms")
         return response
     except Exception as e:
-        import traceback
         logger.error(f"[request_id={request_id}] Error: {e}\n{traceback.format_exc()}")
         raise 
\ No newline at end of file
@@ -8,6 +8,7 @@ from fastapi import FastAPI, Request, Response, status, WebSocket, WebSocketDisc
 from fastapi.responses import StreamingResponse
 import os
 import base64
+import array
 
 # --- CONFIG ---
 DEEPGRAM_API_KEY = os.environ.get("DEEPGRAM_API_KEY", "")
@@ -17,6 +18,21 @@ app = FastAPI()
 logger = logging.getLogger("stt_service")
 logging.basicConfig(level=logging.INFO)
 
+# Optional SIMD base64 decoder (same API as the stdlib one)
+try:
+    from pybase64 import b64decode
+except ImportError:
+    b64decode = base64.b64decode
+    logger.info("[STT] pybase64 not available - using stdlib base64")
+
+# Payloads above this size are base64-decoded on a worker thread so the event loop stays free
+BASE64_OFFLOAD_THRESHOLD = 64 * 1024
+
+async def b64decode_offloaded(data):
+    if len(data) < BASE64_OFFLOAD_THRESHOLD:
+        return b64decode(data)
+    return await asyncio.to_thread(b64decode, data)
+
 def get_deepgram_url():
     params = {
         "encoding": "linear16",
@@ -45,7 +61,6 @@ async def deepgram_stream(audio_chunks):
                         # Audio format validation
                         if len(chunk) % 2 != 0:
                             logger.warning("[STT] First audio chunk length is not a multiple of 2 (not valid 16-bit PCM)")
-                        import array
                         pcm = array.array('h')
                         try:
                             pcm.frombytes(chunk[:min(3200, len(chunk))])
@@ -108,7 +123,7 @@ async def stream_speech_to_text(request: Request):
     try:
         data = json.loads(body)
         logger.info("[STT] Request is JSON, decoding base64 audio_data.")
-        audio_data = base64.b64decode(data["audio_data"])
+        audio_data = await b64decode_offloaded(data["audio_data"])
     except Exception:
         if isinstance(body, (bytes, bytearray)):
             logger.info("[STT] Request is raw PCM bytes.")
@@ -121,7 +136,6 @@ async def stream_speech_to_text(request: Request):
     logger.info(f"[STT] First 32 bytes of audio: {audio_data[:32]}")
     if len(audio_data) % 2 != 0:
         logger.warning("[STT] Audio length is not a multiple of 2 (not valid 16-bit PCM)")
-    import array
     pcm = array.array('h')
     try:
         pcm.frombytes(audio_data[:min(3200, len(audio_data))])
@@ -164,9 +178,15 @@ async def websocket_speech_to_text(ws: WebSocket):
             async def client_to_deepgram():
                 try:
                     while True:
-                        data = await ws.receive_bytes()
-                        # Forward raw PCM bytes to Deepgram
-                        await dg_ws.send(data)
+                        msg = await ws.receive()
+                        if msg["type"] == "websocket.disconnect":
+                            raise WebSocketDisconnect(msg.get("code", 1000))
+                        if msg.get("bytes") is not None:
+                            # Forward raw PCM bytes to Deepgram
+                            await dg_ws.send(msg["bytes"])
+                        elif msg.get("text") is not None:
+                            # Control messages (KeepAlive while the caller's VAD drops silence) go through as text
+                            await dg_ws.send(msg["text"])
                 except WebSocketDisconnect:
                     logger.info("[STT WS] Client disconnected")
                     await dg_ws.close()
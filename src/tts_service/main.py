@@ -6,6 +6,8 @@ from fastapi.responses import StreamingResponse
 import logging
 import time
 import uuid
+import re
+import traceback
 from service import elevenlabs_stream
 
 logging.basicConfig(level=logging.INFO)
@@ -39,7 +41,10 @@ async def stream_text_to_speech_endpoint(request: Request):
     text = data.get("text", "")
     if not text:
         return Response(content=b"", status_code=400)
-    return StreamingResponse(elevenlabs_stream(text), media_type="audio/mpeg")
+    # Optional ElevenLabs output_format (e.g. "pcm_16000") for callers that play raw PCM
+    output_format = data.get("output_format")
+    media_type = "audio/mpeg" if not output_format else "application/octet-stream"
+    return StreamingResponse(elevenlabs_stream(text, output_format=output_format), media_type=media_type)
 
 @app.get("/health")
 async def health():
@@ -48,9 +53,15 @@ async def health():
         return {"status": "error", "error": "Missing ELEVENLABS_API_KEY"}, 500
     return {"status": "ok"}
 
+# Accepted shape for an incoming x-request-id; anything else gets a fresh id
+REQUEST_ID_RE = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
-    request_id = str(uuid.uuid4())
+    # Adopt the caller's id when it is well-formed, so logs line up with the orchestrator's
+    request_id = request.headers.get("x-request-id", "")
+    if not REQUEST_ID_RE.fullmatch(request_id):
+        request_id = str(uuid.uuid4())
     request.state.request_id = request_id
     logger.info(f"[request_id={request_id}] Request: {request.method} {request.url}")
     start = time.time()
@@ -60,7 +71,6 @@ async def log_requests(request: Request, call_next):
         logger.info(f"[request_id={request_id}] Response status: {response.status_code} | Latency: {latency:.2f}ms")
         return response
     except Exception as e:
-        import traceback
         logger.error(f"[request_id={request_id}] Error: {e}\n{traceback.format_exc()}")
         raise 
 
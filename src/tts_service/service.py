@@ -3,8 +3,6 @@
 import os
 import logging
 import httpx
-from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse
 
 # --- CONFIG ---
 ELEVENLABS_API_KEY = os.environ.get("ELEVENLABS_API_KEY", "")
@@ -13,11 +11,10 @@ ELEVENLABS_VOICE_ID = os.environ.get("ELEVENLABS_VOICE_ID", "21m00Tcm4TlvDq8ikWA
 ELEVENLABS_MODEL_ID = os.environ.get("ELEVENLABS_MODEL_ID", "eleven_multilingual_v2")
 ELEVENLABS_URL = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVENLABS_VOICE_ID}/stream"
 
-app = FastAPI()
 logger = logging.getLogger("tts_service")
 logging.basicConfig(level=logging.INFO)
 
-async def elevenlabs_stream(text: str):
+async def elevenlabs_stream(text: str, output_format: str = None):
     headers = {
         "xi-api-key": ELEVENLABS_API_KEY,
         "Content-Type": "application/json",
@@ -30,7 +27,9 @@ async def elevenlabs_stream(text: str):
     }
     try:
         async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("POST", ELEVENLABS_URL, headers=headers, json=payload) as resp:
+            # output_format (e.g. "pcm_16000") lets realtime callers skip MP3 decoding
+            params = {"output_format": output_format} if output_format else None
+            async with client.stream("POST", ELEVENLABS_URL, headers=headers, json=payload, params=params) as resp:
                 if resp.status_code != 200:
                     error_body = await resp.aread()
                     logger.error(f"TTS error: {resp.status_code} {error_body.decode(errors='ignore')}")
@@ -43,34 +42,3 @@ async def elevenlabs_stream(text: str):
     except Exception as e:
         logger.error(f"ElevenLabs TTS connection failed: {e}")
         yield b""
-
-@app.post("/stream-text-to-speech")
-async def stream_text_to_speech(request: Request):
-    data = await request.json()
-    text = data.get("text", "")
-    if not text:
-        return Response(content=b"", status_code=400)
-    return StreamingResponse(elevenlabs_stream(text), media_type="audio/mpeg")
-
-@app.websocket("/ws/stream-text-to-speech")
-async def websocket_text_to_speech(ws: WebSocket):
-    await ws.accept()
-    logger.info("[TTS WS] Client connected")
-    try:
-        while True:
-            try:
-                data = await ws.receive_text()
-            except WebSocketDisconnect:
-                logger.info("[TTS WS] Client disconnected")
-                break
-            except Exception as e:
-                logger.error(f"[TTS WS] Receive error: {e}")
-                break
-            # Stream to ElevenLabs
-            async for chunk in elevenlabs_stream(data):
-                await ws.send_bytes(chunk)
-    except Exception as e:
-        logger.error(f"[TTS WS] Unexpected error: {e}")
-    finally:
-        await ws.close()
-        logger.info("[TTS WS] Connection closed") 
\ No newline at end of file
@@ -1,10 +1,13 @@
 import redis.asyncio as redis
 import json
 import os
+import logging
+
+logger = logging.getLogger("redis_session")
 
 # Always use the Redis service name in the Docker network
 REDIS_URL = "redis://redis:6379/0"
-print(f"[DEBUG] REDIS_URL hardcoded to: {REDIS_URL}")
+logger.debug("REDIS_URL hardcoded to: %s", REDIS_URL)
 
 async def get_redis():
     return await redis.from_url(REDIS_URL, decode_responses=True)